@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+"""
+Measure pyp throughput on synthetic inputs, for each input mode.
+
+Each benchmark runs the pyp command on a generated file, and reports the
+lines and MB processed per second and the peak memory of the process.
+The same statements are also run through execute_statements(), in this
+process, to measure the engine without the startup time, which is
+measured on its own.
+
+    $ python benchmarks/bench.py --lines 1000000 --output before.json
+    $ git checkout my-branch
+    $ python benchmarks/bench.py --lines 1000000 --compare before.json
+
+Only the standard library is needed.
+"""
+
+from __future__ import (unicode_literals, absolute_import,
+                        print_function, division)
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pyped import (execute_statements, RecordReader, Output, CodeCache,
+                   __VERSION__)
+
+
+# name: (input, pyp arguments)
+BENCHMARKS = [
+    ('line', ('text', ["print(x)"])),
+    ('filter', ('text', ["-f", "x.endswith('7')"])),
+    ('print', ('text', ["-p", "x.upper()"])),
+    ('split', ('text', ["-s", " ", "-p", "f[1]"])),
+    ('iterable', ('text', ["-i", "print(sum(1 for x in l))"])),
+    ('full', ('text', ["--full", "print(stdin.count('\\n'))"])),
+    ('json', ('json', ["--json", "print(len(j))"])),
+]
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+         "adipiscing", "elit", "sed", "do", "eiusmod", "tempor"]
+
+
+def generate_inputs(directory, lines, seed=0):
+    """ Write the synthetic inputs in directory, return {kind: path} """
+    rand = random.Random(seed)
+    text = os.path.join(directory, 'input.txt')
+    with open(text, 'w') as f:
+        for n in range(lines):
+            f.write("%s %s %s %.3f\n" % (n, rand.choice(WORDS),
+                                         rand.choice(WORDS), rand.random()))
+    document = os.path.join(directory, 'input.json')
+    with open(document, 'w') as f:
+        json.dump([{'id': n, 'name': rand.choice(WORDS),
+                    'score': rand.random()} for n in range(lines)], f)
+    return {'text': text, 'json': document}
+
+
+def cli_options(arguments):
+    """ Turn pyp command line arguments into execute_statements() options """
+    options = {}
+    statements = []
+    arguments = list(arguments)
+    while arguments:
+        argument = arguments.pop(0)
+        if argument == '-s':
+            options['split'] = arguments.pop(0)
+        elif argument in ('-f', '-p', '-i', '--full', '--json'):
+            options[{'-f': 'filter_input', '-p': 'autoprint',
+                     '-i': 'iterable', '--full': 'full',
+                     '--json': 'parse_json'}[argument]] = True
+        else:
+            statements.append(argument)
+    return statements, options
+
+
+def run_command(arguments, path=None):
+    """ Run pyp, return (seconds, peak RSS in MB) """
+    command = [sys.executable, os.path.join(ROOT, 'pyped.py')] + arguments
+    with open(path or os.devnull, 'rb') as stdin:
+        with open(os.devnull, 'wb') as stdout:
+            start = time.time()
+            process = subprocess.Popen(command, stdin=stdin, stdout=stdout)
+            status, usage = os.wait4(process.pid, 0)[1:]
+            seconds = time.time() - start
+    if status:
+        raise RuntimeError("pyp %s failed" % " ".join(arguments))
+    # ru_maxrss is in kilobytes on Linux, and in bytes on Mac OS
+    rss = usage.ru_maxrss / 1024
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return seconds, rss
+
+
+def run_engine(arguments, path):
+    """ Run the statements with execute_statements(), return the seconds """
+    statements, options = cli_options(arguments)
+    with open(os.devnull, 'w') as devnull:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            start = time.time()
+            execute_statements(statements, RecordReader(fd, 'utf8'),
+                               additional_context={}, prelude=True,
+                               cache=CodeCache(), output=Output(devnull),
+                               **options)
+            return time.time() - start
+        finally:
+            os.close(fd)
+
+
+def measure(inputs, lines, repeat=3, names=None):
+    """ Run the benchmarks, keep the best of repeat runs """
+    results = {}
+    for name, (kind, arguments) in BENCHMARKS:
+        if names and name not in names:
+            continue
+        path = inputs[kind]
+        size = os.path.getsize(path)
+        run_command(arguments, path) # warm the cache of compiled statements
+        runs = [run_command(arguments, path) for n in range(repeat)]
+        seconds = min(seconds for seconds, rss in runs)
+        engine = min(run_engine(arguments, path) for n in range(repeat))
+        results[name] = {
+            'command': "pyp " + " ".join(arguments),
+            'seconds': seconds,
+            'engine_seconds': engine,
+            'lines_per_sec': lines / seconds,
+            'mb_per_sec': size / 1024 / 1024 / seconds,
+            'engine_lines_per_sec': lines / engine,
+            'peak_rss_mb': max(rss for seconds, rss in runs),
+        }
+        report(name, results[name])
+
+    startup = [run_command(["pass"])[0] for n in range(repeat * 5)]
+    results['startup'] = {'command': "pyp pass", 'seconds': min(startup)}
+    report('startup', results['startup'])
+    return results
+
+
+def report(name, result, previous=None):
+    """ Print one line for the result, compared to the previous one """
+    if 'lines_per_sec' in result:
+        line = ("%-10s %8.3fs %10.0f lines/s %7.1f MB/s %10.0f lines/s "
+                "in engine %7.1f MB RSS" % (name, result['seconds'],
+                                            result['lines_per_sec'],
+                                            result['mb_per_sec'],
+                                            result['engine_lines_per_sec'],
+                                            result['peak_rss_mb']))
+    else:
+        line = "%-10s %8.1fms" % (name, result['seconds'] * 1000)
+    if previous:
+        line += "  %+6.1f%%" % ((result['seconds'] / previous['seconds'] - 1)
+                                * 100)
+    print(line)
+
+
+def compare(results, previous):
+    """ Print the results next to the ones of a previous run """
+    print("\nCompared to %s (%s lines, Python %s):" % (
+          previous['version'], previous['lines'], previous['python']))
+    for name, result in sorted(results['benchmarks'].items()):
+        report(name, result, previous['benchmarks'].get(name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=200000,
+                        help="The number of lines of the inputs.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Run each benchmark this many times and keep "
+                             "the best time.")
+    parser.add_argument("--only", nargs='+', metavar="name",
+                        choices=[name for name, spec in BENCHMARKS],
+                        help="Only run these benchmarks.")
+    parser.add_argument("--output", metavar="file.json",
+                        help="Save the results in this file.")
+    parser.add_argument("--compare", metavar="file.json",
+                        help="Compare the results with a previous run.")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='pyp-bench-')
+    try:
+        print("Generating %s lines of input..." % args.lines)
+        inputs = generate_inputs(directory, args.lines)
+        results = {
+            'version': __VERSION__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'lines': args.lines,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks': measure(inputs, args.lines, args.repeat,
+                                  args.only),
+        }
+    finally:
+        for path in os.listdir(directory):
+            os.remove(os.path.join(directory, path))
+        os.rmdir(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
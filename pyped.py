@@ -23,213 +23,2767 @@ More informations: https://github.com/ksamuel/Pyped
 __VERSION__ = "1.4"
 
 
-# we won't use all of these, they are imported to be available to
-# the shell user
-
 import sys
+import gc
 import os
 import re
 import json
-import base64
-import csv
-import tempfile
+import time
 import argparse
-import random
-import math
 import stat
 import itertools
+import types
+import codecs
+import binascii
+import linecache
+import importlib
+
+from io import BytesIO, StringIO
+from functools import partial
+from collections import deque
+from operator import methodcaller
+from itertools import islice
 
-from itertools import chain, cycle, islice, repeat, tee, groupby
+# Python 3 compat
+from six import exec_, text_type, PY3
+
+
+# Modules and objects made available to the shell user, as
+# name: (module, attribute). They are only imported the first time a
+# statement uses them so that "pyp -f x" doesn't pay for importing requests.
+PRELUDE = [
+    ('sys', ('sys', None)),
+    ('os', ('os', None)),
+    ('re', ('re', None)),
+    ('json', ('json', None)),
+    ('base64', ('base64', None)),
+    ('csv', ('csv', None)),
+    ('tempfile', ('tempfile', None)),
+    ('random', ('random', None)),
+    ('math', ('math', None)),
+    ('itertools', ('itertools', None)),
+    ('chain', ('itertools', 'chain')),
+    ('cycle', ('itertools', 'cycle')),
+    ('islice', ('itertools', 'islice')),
+    ('repeat', ('itertools', 'repeat')),
+    ('tee', ('itertools', 'tee')),
+    ('groupby', ('itertools', 'groupby')),
+    ('uuid4', ('uuid', 'uuid4')),
+    ('datetime', ('datetime', 'datetime')),
+    ('timedelta', ('datetime', 'timedelta')),
+    ('Counter', ('collections', 'Counter')),
+    ('OrderedDict', ('collections', 'OrderedDict')),
+    ('md5', ('hashlib', 'md5')),
+    ('sha1', ('hashlib', 'sha1')),
+    ('sha256', ('hashlib', 'sha256')),
+    ('pprint', ('pprint', 'pprint')),
+    # third party
+    ('arrow', ('arrow', None)),
+    ('requests', ('requests', None)),
+    ('slugify', ('minibelt', 'slugify')),
+    ('normalize', ('minibelt', 'normalize')),
+    ('attr', ('minibelt', 'attr')),
+    ('dmerge', ('minibelt', 'dmerge')),
+    ('flatten', ('minibelt', 'flatten')),
+    ('get', ('minibelt', 'get')),
+    ('iget', ('minibelt', 'iget')),
+    ('skip_duplicates', ('minibelt', 'skip_duplicates')),
+    ('sset', ('minibelt', 'sset')),
+    ('path', ('path', 'path')),
+    ('np', ('numpy', None)),
+]
 
-from uuid import uuid4
-from datetime import datetime, timedelta
-from collections import Counter, OrderedDict
-from hashlib import md5, sha1, sha256
-from pprint import pprint
+if not PY3:
+    PRELUDE.extend([
+        ('imap', ('itertools', 'imap')),
+        ('izip', ('itertools', 'izip')),
+        ('izip_longest', ('itertools', 'izip_longest')),
+    ])
+
+
+def import_prelude(name, log=None):
+    """ Import the object a prelude name stands for.
+
+        If log is a list, a (name, module, seconds) tuple is appended to it.
+    """
+    module, attribute = dict(PRELUDE)[name]
+    start = time.time()
+    value = importlib.import_module(module)
+    if attribute:
+        value = getattr(value, attribute)
+    if log is not None:
+        log.append((name, module, time.time() - start))
+    return value
+
+
+class LazyImport(object):
+    """ Stand-in for a prelude name, importing it on first use.
+
+        Once imported, the real object replaces the stand-in in the context
+        so following lookups don't go through the proxy anymore.
+    """
+
+    def __init__(self, context, name, log=None):
+        self._context = context
+        self._name = name
+        self._log = log
+        self._value = None
+
+    def _resolve(self):
+        if self._value is None:
+            self._value = import_prelude(self._name, self._log)
+            if self._context.get(self._name) is self:
+                self._context[self._name] = self._value
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._resolve())
+
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self._resolve())
+
+    def __repr__(self):
+        return repr(self._resolve())
+
+
+def prelude_context(log=None):
+    """ Return a context with a lazy stand-in for each prelude name """
+    context = {}
+    for name, spec in PRELUDE:
+        context[name] = LazyImport(context, name, log)
+    return context
+
+
+def referenced_names(codes):
+    """ Return the names used by the code objects and the nested ones """
+    names = set()
+    codes = [code for code in codes if isinstance(code, types.CodeType)]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(const for const in code.co_consts
+                     if isinstance(const, types.CodeType))
+    return names
+
+
+def load_prelude(context, codes, log=None):
+    """ Add the prelude names the code objects use to the context.
+
+        Only these names are imported, eagerly, and the rest of the prelude
+        is skipped. Names that can't be imported are ignored. If the code
+        can run dynamic code with eval() or exec(), which we can't analyze,
+        the remaining names are added as lazy stand-ins.
+    """
+    names = referenced_names(codes)
+    dynamic = not names.isdisjoint(UNFUSABLE_NAMES)
+    for name, spec in PRELUDE:
+        if name in context:
+            continue
+        if name in names:
+            try:
+                context[name] = import_prelude(name, log)
+            except ImportError:
+                pass
+        elif dynamic:
+            context[name] = LazyImport(context, name, log)
+    return context
+
+
+class Output(object):
+    """ Buffered replacement for print(), writing to stdout.
+
+        Printed text is accumulated, then encoded and written in bulk when
+        there is more than buffer_size characters waiting, on flush() or
+        when closed. In line buffered mode, each call is written right away,
+        which is what you want for an interactive terminal or "tail -f".
+
+        In binary mode, bytes are written as is and anything else is
+        encoded, instead of printing the repr() of bytes.
+
+        print(..., file=something) still goes through the real print().
+
+        It's also a file like object, installed as sys.stdout while the
+        statements run, so what they write to it directly, e.g. with
+        pprint(), comes out in order with what they print. Anything else
+        than write() and flush(), like fileno() or buffer, flushes the
+        buffer and comes from the stream.
+    """
+
+    def __init__(self, stream=None, buffer_size=64 * 1024,
+                 line_buffered=False, binary=False):
+        self.stream = stream or sys.stdout
+        self.raw = getattr(self.stream, 'buffer', None)
+        self.encoding = getattr(self.stream, 'encoding', None) or 'utf8'
+        self.errors = getattr(self.stream, 'errors', None) or 'strict'
+        self.buffer_size = buffer_size
+        self.line_buffered = line_buffered
+        self.binary = binary
+        if binary:
+            self.convert, self.empty, self.space, self.newline = (
+                self.to_bytes, b"", b" ", b"\n")
+        else:
+            self.convert, self.empty, self.space, self.newline = (
+                text_type, "", " ", "\n")
+        self.pieces = []
+        self.size = 0
+
+    def to_bytes(self, value):
+        if isinstance(value, (bytes, bytearray)):
+            return value
+        # a memory map, like "x" with -i on a file, if mmap is imported
+        mmap = sys.modules.get('mmap')
+        if mmap is not None and isinstance(value, mmap.mmap):
+            return value
+        return text_type(value).encode(self.encoding, self.errors)
+
+    def add(self, data):
+        """ Add data, already converted, to the buffer """
+        self.pieces.append(data)
+        self.size += len(data)
+        if self.line_buffered or self.size > self.buffer_size:
+            self.flush()
+
+    def write(self, text):
+        """ Add text to the buffer, like the write() of a file """
+        if self.binary and not isinstance(text, bytes):
+            text = text.encode(self.encoding, self.errors)
+        elif not self.binary and isinstance(text, bytes):
+            # e.g: pprint() on Python 2
+            text = text.decode(self.encoding, self.errors)
+        self.add(text)
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def __call__(self, *args, **kwargs):
+        if not kwargs:
+            # fast path for the most common call
+            return self.add(self.space.join(map(self.convert, args))
+                            + self.newline)
+        if kwargs.get('file') not in (None, self, self.stream):
+            return print(*args, **kwargs)
+        sep = kwargs.get('sep')
+        end = kwargs.get('end')
+        sep = self.space if sep is None else self.convert(sep)
+        end = self.newline if end is None else self.convert(end)
+        self.add(sep.join(map(self.convert, args)) + end)
+        if kwargs.get('flush'):
+            self.flush()
+
+    def flush(self):
+        if self.pieces:
+            data = self.empty.join(self.pieces)
+            self.pieces = []
+            self.size = 0
+            if self.raw is None:
+                self.stream.write(data)
+            else:
+                # anything written directly to the stream must go first
+                self.stream.flush()
+                if not self.binary:
+                    data = data.encode(self.encoding, self.errors)
+                self.raw.write(data)
+        if self.raw is not None:
+            self.raw.flush()
+        else:
+            self.stream.flush()
+
+    close = flush
+
+    # writing to the stream around us flushes what we have first. No
+    # __getattr__() for the rest: it would slow down all the attributes
+
+    @property
+    def buffer(self):
+        self.flush()
+        return self.stream.buffer
+
+    def fileno(self):
+        self.flush()
+        return self.stream.fileno()
+
+    def isatty(self):
+        return self.stream.isatty()
+
+
+class RecordReader(object):
+    """ Read records from a file descriptor in big blocks.
+
+        Each block is split on the record separator in bulk, the trailing
+        partial record being kept for the next block, instead of iterating
+        on a text file line by line. If an encoding is given, the complete
+        records of a block are decoded at once and the records are text,
+        otherwise they are bytes.
+
+        Iterating on the reader yields the records with their separator,
+        like lines from a file. lines() yields them right stripped.
+    """
+
+    block_size = 1024 * 1024
+    # the text stdin of Python 3 only translates Windows line breaks on
+    # Windows: keep them everywhere else, like it does
+    universal_newlines = PY3 and os.name == 'nt'
+
+    def __init__(self, fd=0, encoding=None, separator="\n", block_size=None,
+                 errors='strict'):
+        self.fd = fd
+        self.encoding = encoding
+        self.errors = errors
+        if block_size:
+            self.block_size = block_size
+        if isinstance(separator, text_type):
+            separator = separator.encode(encoding or 'utf8')
+        self.raw_separator = separator
+        self.separator = separator
+        if encoding:
+            self.separator = separator.decode(encoding)
+        # the number of bytes read so far, and of records split by lines()
+        self.bytes_read = 0
+        self.records_read = 0
+
+    def decode(self, data):
+        if not self.encoding:
+            return data
+        data = data.decode(self.encoding, self.errors)
+        if (self.universal_newlines and self.separator == "\n"
+                and "\r" in data):
+            data = data.replace("\r\n", "\n")
+        return data
+
+    def read_block(self, size=None):
+        data = os.read(self.fd, size or self.block_size)
+        self.bytes_read += len(data)
+        return data
+
+    def chunks(self):
+        """ Yield chunks of data made of complete records """
+        separator = self.raw_separator
+        rest = b""
+        while True:
+            block = self.read_block()
+            if not block:
+                break
+            end = block.rfind(separator)
+            if end == -1:
+                rest += block
+                continue
+            end += len(separator)
+            yield self.decode(rest + block[:end] if rest else block[:end])
+            rest = block[end:]
+        if rest:
+            yield self.decode(rest)
+
+    def lines(self, rstrip=""):
+        """ Yield the records, right stripped of the rstrip characters """
+        separator = self.separator
+        for chunk in self.chunks():
+            records = chunk.split(separator)
+            # the last record is empty if the chunk ends with a separator,
+            # otherwise it's the end of the input, without separator
+            last = records.pop()
+            self.records_read += len(records) + bool(last)
+            if rstrip == separator:
+                # fast path: splitting already removed the separator
+                for record in records:
+                    yield record
+            else:
+                for record in records:
+                    yield (record + separator).rstrip(rstrip)
+            if last:
+                yield last.rstrip(rstrip)
 
-try:
-    import arrow
-except ImportError:
-    pass
+    def __iter__(self):
+        return self.lines()
 
-try:
-    import requests
-except ImportError:
-    pass
+    def read(self):
+        """ Return all the remaining data """
+        return self.decode(b"".join(iter(self.read_block, b"")))
 
-try:
-    from minibelt import (slugify, normalize, attr, dmerge, flatten,
-                          get, iget, skip_duplicates, sset)
-except ImportError:
-    pass
 
-try:
-    from path import path
-except ImportError:
-    pass
+MappedFile = None
 
-# Python 3 compat
-from six import exec_, PY3
 
+def mapped_file_type():
+    """ Return the MappedFile class: a read only memory map of a file,
+        usable like bytes without copying the data for what mmap supports:
+        slicing, len(), find(), re...
+
+        The other bytes methods, like split() or decode(), work on a copy.
+
+        The class is created on the first call, so mmap is only imported
+        when a file is mapped.
+    """
+    global MappedFile
+    if MappedFile is not None:
+        return MappedFile
+
+    import mmap
+
+    class MappedFile(mmap.mmap):
+
+        def __getattr__(self, name):
+            return getattr(self[:], name)
+
+        def __repr__(self):
+            return repr(self[:])
+
+        def __contains__(self, value):
+            return self.find(value) != -1
+
+        def __eq__(self, other):
+            return self[:] == other
+
+        def __ne__(self, other):
+            return not self == other
+
+        __hash__ = None
+
+    return MappedFile
+
+
+class MappedReader(RecordReader):
+    """ RecordReader on a regular file, mapped in memory instead of read.
+
+        Records are found directly in the mapping, and chunks are decoded
+        from it without copying them in bytes first. Fall back to reading
+        the file if it can't be mapped.
+    """
+
+    def __init__(self, fd=0, *args, **kwargs):
+        super(MappedReader, self).__init__(fd, *args, **kwargs)
+        import mmap
+        try:
+            self.map = mapped_file_type()(fd, 0, access=mmap.ACCESS_READ)
+            self.position = self.released = os.lseek(fd, 0, os.SEEK_CUR)
+        except (ValueError, EnvironmentError):
+            self.map = None # e.g: empty files can't be mapped
+        else:
+            if hasattr(self.map, 'madvise'):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def advance(self, end):
+        """ Consume the mapping up to end, and return where it started """
+        start = self.position
+        self.position = end
+        self.bytes_read += end - start
+        # keep the file offset right for the next process reading it
+        os.lseek(self.fd, end, os.SEEK_SET)
+        return start
+
+    def release(self):
+        """ Let the kernel drop the pages already consumed, so they don't
+            pile up in memory
+        """
+        import mmap
+        end = self.position - self.position % mmap.PAGESIZE
+        if end > self.released and hasattr(self.map, 'madvise'):
+            start = self.released - self.released % mmap.PAGESIZE
+            self.map.madvise(mmap.MADV_DONTNEED, start, end - start)
+            self.released = end
+
+    def decode(self, data):
+        if not self.encoding:
+            return data
+        data = codecs.decode(data, self.encoding, self.errors)
+        if (self.universal_newlines and self.separator == "\n"
+                and "\r" in data):
+            data = data.replace("\r\n", "\n")
+        return data
+
+    def decode_range(self, start, end):
+        """ Return the data of the mapping between start and end, decoded
+            without an intermediary copy if it's text.
+        """
+        if not self.encoding or not PY3:
+            # the mmap of Python 2 doesn't give a buffer to memoryview
+            return self.decode(self.map[start:end])
+        view = memoryview(self.map)
+        try:
+            return self.decode(view[start:end])
+        finally:
+            view.release()
+
+    def ranges(self, size):
+        """ Split the rest of the mapping in (start, end) ranges of about
+            size bytes, made of complete records
+        """
+        ranges = []
+        start, length = self.position, len(self.map)
+        while start < length:
+            end = start + size
+            if end < length:
+                end = self.map.find(self.raw_separator, end)
+                end = length if end == -1 else end + len(self.raw_separator)
+            end = min(end, length)
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def count_records(self, start, end):
+        """ Return the number of records between start and end """
+        data = self.map[start:end]
+        count = data.count(self.raw_separator)
+        if data and not data.endswith(self.raw_separator):
+            count += 1
+        return count
+
+    def read_block(self, size=None):
+        if self.map is None:
+            return super(MappedReader, self).read_block(size)
+        end = min(self.position + (size or self.block_size), len(self.map))
+        start = self.advance(end)
+        data = self.map[start:end]
+        self.release()
+        return data
+
+    def chunks(self):
+        if self.map is None:
+            for chunk in super(MappedReader, self).chunks():
+                yield chunk
+            return
+        mapping, separator = self.map, self.raw_separator
+        size = len(mapping)
+        while self.position < size:
+            end = self.position + self.block_size
+            if end < size:
+                # cut after the last record separator of the block, or of
+                # the record if it's bigger than the block
+                cut = mapping.rfind(separator, self.position, end)
+                if cut == -1:
+                    cut = mapping.find(separator, end)
+                end = size if cut == -1 else cut + len(separator)
+            end = min(end, size)
+            start = self.advance(end)
+            chunk = self.decode_range(start, end)
+            self.release()
+            yield chunk
+
+    def read(self):
+        if self.map is None:
+            return super(MappedReader, self).read()
+        start = self.advance(len(self.map))
+        if start == 0 and not self.encoding:
+            return self.map # no copy at all
+        data = self.decode_range(start, len(self.map))
+        self.release()
+        return data
+
+
+class ChunkReader(RecordReader):
+    """ RecordReader on a chunk of records already read and decoded,
+        e.g: by the parent process in parallel mode.
+    """
+
+    def __init__(self, chunk, separator):
+        self.chunk = chunk
+        self.separator = separator
+        self.encoding = None
+        self.bytes_read = 0
+        self.records_read = 0
+
+    def chunks(self):
+        yield self.chunk
+
+
+REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+def make_splitter(pattern, maxsplit=0):
+    """ Return a function splitting a line like re.split(pattern, line),
+        using str.split() when the pattern allows it since it's much faster.
+
+        A literal pattern is always split by str.split(). The default
+        whitespace pattern is too, unless the line is empty or starts or ends
+        with whitespace, where str.split() wouldn't return the empty fields
+        re.split() does.
+    """
+    split = re.compile(pattern).split
+    try:
+        text = pattern.decode('latin1')
+    except AttributeError:
+        text = pattern # not bytes
+
+    if text and not REGEX_SPECIAL_CHARS.intersection(text):
+        return methodcaller('split', pattern, maxsplit or -1)
+
+    if text == r'\s+':
+        def split_whitespace(line):
+            if not line or line[:1].isspace() or line[-1:].isspace():
+                return split(line, maxsplit)
+            return line.split(None, maxsplit or -1)
+        return split_whitespace
+
+    if maxsplit:
+        return partial(split, maxsplit=maxsplit)
+    return split
+
+
+class Fields(object):
+    """ The fields of a line, only split when they are first accessed """
+
+    __slots__ = ('line', 'split', '_fields')
+
+    def __init__(self, line, split):
+        self.line = line
+        self.split = split
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.split(self.line)
+        return self._fields
+
+    def __getitem__(self, index):
+        return self.fields[index]
+
+    def __setitem__(self, index, value):
+        self.fields[index] = value
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __reversed__(self):
+        return reversed(self.fields)
+
+    def __contains__(self, value):
+        return value in self.fields
+
+    def __eq__(self, other):
+        if isinstance(other, Fields):
+            other = other.fields
+        return self.fields == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return self.fields + list(other)
+
+    def __repr__(self):
+        return repr(self.fields)
+
+    def index(self, *args):
+        return self.fields.index(*args)
+
+    def count(self, value):
+        return self.fields.count(value)
+
+
+class AwkFields(object):
+    """ AWK-like access to the fields of a line, available as 'F'.
+
+        F[1] is the first field, like $1, F[0] the whole line, F[-1] the last
+        field, F[2:] the fields from the second one and F.nf the number of
+        fields. F.int(n) and F.float(n) convert a field to a number once per
+        line, however many times they are called.
+    """
+
+    __slots__ = ('line', 'split', '_fields', '_ints', '_floats')
+
+    def __init__(self, line, split=methodcaller('split')):
+        self.line = line
+        self.split = split
+        self._fields = self._ints = self._floats = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.split(self.line)
+        return self._fields
+
+    @property
+    def nf(self):
+        return len(self.fields)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # field numbers too: F[1:3] is [F[1], F[2]]
+            start, stop = index.start, index.stop
+            if start and start > 0:
+                start -= 1
+            if stop and stop > 0:
+                stop -= 1
+            return self.fields[start:stop:index.step]
+        if index > 0:
+            return self.fields[index - 1]
+        if index == 0:
+            return self.line
+        return self.fields[index]
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __repr__(self):
+        return "F(%r)" % (self.line,)
+
+    def int(self, index):
+        if self._ints is None:
+            self._ints = {}
+        try:
+            return self._ints[index]
+        except KeyError:
+            value = self._ints[index] = int(self[index])
+            return value
+
+    def float(self, index):
+        if self._floats is None:
+            self._floats = {}
+        try:
+            return self._floats[index]
+        except KeyError:
+            value = self._floats[index] = float(self[index])
+            return value
+
+
+class ByteWindow(deque):
+    """ deque of the last lines, dropping the oldest ones when they add up
+        to more than size characters, or bytes, but the last line.
+    """
+
+    def __init__(self, size):
+        super(ByteWindow, self).__init__()
+        self.size = size
+        self.length = 0
+
+    def append(self, line):
+        deque.append(self, line)
+        self.length += len(line)
+        while self.length > self.size and len(self) > 1:
+            self.popleft()
+
+    def popleft(self):
+        line = deque.popleft(self)
+        self.length -= len(line)
+        return line
+
+    def pop(self):
+        line = deque.pop(self)
+        self.length -= len(line)
+        return line
+
+    def clear(self):
+        deque.clear(self)
+        self.length = 0
+
+
+class Row(object):
+    """ Read only mapping view of a CSV row, by the names of the header.
+
+        The names are mapped to indexes once for all the rows, so getting a
+        field by name doesn't build a dict for each row.
+    """
+
+    __slots__ = ('row', 'indexes')
+
+    def __init__(self, row, indexes):
+        self.row = row
+        self.indexes = indexes
+
+    def __getitem__(self, name):
+        return self.row[self.indexes[name]]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except (KeyError, IndexError):
+            return default
+
+    def keys(self):
+        return sorted(self.indexes, key=self.indexes.get)
+
+    def values(self):
+        return [self.row[n] for n in sorted(self.indexes.values())]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __contains__(self, name):
+        return name in self.indexes
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class JSONStream(object):
+    """ Incremental JSON parser yielding the values found at a path.
+
+        The path is made of keys separated by dots, "*" matching all the
+        items of an array or all the values of an object, e.g: "items.*"
+        yields each element of the "items" array of the top-level object.
+        The default "*" yields each element of a top-level array.
+
+        Only one value at the path is in memory at a time, and the stream
+        is read by blocks, so memory stays bounded by the biggest value
+        instead of the size of the document. Values not on the path are
+        parsed and dropped.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+    block_size = 64 * 1024
+
+    def __init__(self, stream, path="*", encoding='utf8'):
+        self.stream = stream
+        self.path = [key for key in path.split('.') if key] if path else []
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size):
+        if hasattr(self.stream, 'read_block'):
+            return self.stream.read_block(size)  # a RecordReader
+        return self.stream.read(size)
+
+    def more(self, size=None):
+        """ Append data to the buffer, return False at the end of stdin.
+
+            Read a block, or at least size bytes if size is given, even if
+            it takes several reads, e.g: from a pipe.
+        """
+        data = self.read(size or self.block_size)
+        if size and data:
+            blocks = [data]
+            size -= len(data)
+            while size > 0:
+                data = self.read(size)
+                if not data:
+                    break
+                blocks.append(data)
+                size -= len(data)
+            data = blocks[0][:0].join(blocks)
+        if not data:
+            self.eof = True
+        if isinstance(data, bytes):
+            data = self.decoder.decode(data, final=self.eof)
+        # drop what is already parsed
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """ Skip whitespaces, return the next character or "" at the end """
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                return ""
+
+    def expect(self, *characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError("Expecting %s at position %s of the JSON stream "
+                             "buffer, got %r" % (" or ".join(characters),
+                                                 self.pos, character))
+        self.pos += 1
+        return character
+
+    def value(self):
+        """ Parse the next complete value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer,
+                                                          self.pos)
+            except ValueError:
+                # incomplete value: parse it again once what we have of it
+                # doubled, not once per block, or it would be quadratic
+                if self.more(max(len(self.buffer) - self.pos,
+                                 self.block_size)):
+                    continue
+                raise
+            if end == len(self.buffer) and self.more():
+                continue  # a number could go on in the next block
+            self.pos = end
+            return value
+
+    def walk(self, path):
+        if not path:
+            yield self.value()
+            return
+
+        key, rest = path[0], path[1:]
+        character = self.peek()
+        if character not in ('[', '{'):
+            self.value()  # nothing to walk into
+            return
+
+        self.pos += 1
+        closing = ']' if character == '[' else '}'
+        if self.peek() == closing:
+            self.pos += 1
+            return
+
+        index = 0
+        while True:
+            name = str(index)
+            if closing == '}':
+                name = self.value()
+                self.expect(':')
+            if key in ('*', name):
+                for value in self.walk(rest):
+                    yield value
+            else:
+                self.value()
+            if self.expect(',', closing) == closing:
+                return
+            index += 1
+
+    def __iter__(self):
+        return self.walk(self.path)
+
+
+def json_codec():
+    """ Return the fastest (loads, dumps) JSON functions available.
+
+        orjson or ujson are used if they are installed, otherwise the
+        json module, with a single encoder created once. They all output
+        compact JSON.
+    """
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        def dumps(value):
+            try:
+                return orjson.dumps(value).decode('utf8')
+            except TypeError:
+                # e.g: orjson doesn't accept non string keys
+                return encoder.encode(value)
+        return orjson.loads, dumps
+
+    try:
+        import ujson
+    except ImportError:
+        return json.loads, encoder.encode
+    return ujson.loads, partial(ujson.dumps, ensure_ascii=False)
+
+
+def decode_json_lines(lines, loads=json.loads, quiet=False, start=1,
+                      batch_size=1000):
+    """ Yield a (line, index, value) tuple for each JSON line.
+
+        Lines are decoded by batches, as one JSON array, so there is a
+        single call to loads() per batch. A random string is put between
+        the lines in this array, so a line holding several values, or
+        several lines making one value, can't go unnoticed. Only if this
+        fails are the lines of the batch decoded one by one, to find the
+        malformed ones, which are skipped in quiet mode. Blank lines are
+        ignored.
+    """
+    marker = binascii.hexlify(os.urandom(8)).decode('ascii')
+    text_separator = ',"%s",' % marker
+    numbered = enumerate(lines, start)
+    while True:
+        batch = [(line, i) for i, line in islice(numbered, batch_size)]
+        if not batch:
+            return
+        batch = [(line, i) for line, i in batch if line.strip()]
+        if not batch:
+            continue
+        if isinstance(batch[0][0], text_type):
+            array = "[%s]" % text_separator.join(line for line, i in batch)
+        else:
+            separator = text_separator.encode('ascii')
+            array = b"[" + separator.join(line for line, i in batch) + b"]"
+        try:
+            values = loads(array)
+            if (len(values) != 2 * len(batch) - 1 or
+                    values[1::2].count(marker) != len(batch) - 1):
+                raise ValueError("A line is not a single JSON value")
+        except ValueError:
+            for line, i in batch:
+                try:
+                    yield line, i, loads(line)
+                except ValueError:
+                    if not quiet:
+                        raise
+        else:
+            for (line, i), value in zip(batch, values[::2]):
+                yield line, i, value
+
+
+# Shortcuts for the NumPy types of a --schema
+COLUMN_TYPES = {'int': 'int64', 'float': 'float64', 'str': 'U', 'bytes': 'S'}
+
+
+def parse_schema(schema):
+    """ Parse a schema like "str,int,price:float" in (name, dtype) tuples.
+
+        Types are NumPy dtypes or one of COLUMN_TYPES, names are optional.
+    """
+    columns = []
+    for item in schema.split(','):
+        name, _, kind = item.strip().rpartition(':')
+        kind = kind.strip()
+        columns.append((name.strip() or None, COLUMN_TYPES.get(kind, kind)))
+    return columns
+
+
+class Columns(list):
+    """ The columns of a chunk of lines as NumPy arrays, by position or by
+        their name in the schema.
+    """
+
+    def __init__(self, arrays, names=()):
+        list.__init__(self, arrays)
+        self.names = dict((name, n) for n, name in enumerate(names) if name)
+
+    def __getitem__(self, index):
+        try:
+            return list.__getitem__(self, index)
+        except TypeError:
+            return list.__getitem__(self, self.names[index])
+
+
+def column_chunks(lines, split, schema=None, size=64 * 1024, quiet=False,
+                  start=1):
+    """ Yield (lines, i, cols) for each chunk of size lines.
+
+        'cols' contains a NumPy array per field, typed according to the
+        schema, and 'i' is the number of the first line of the chunk. Lines
+        without as many fields as the first one raise a ValueError, or are
+        skipped in quiet mode.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("The columns mode requires numpy to be installed")
+
+    schema = parse_schema(schema) if schema else []
+    names = [name for name, dtype in schema]
+    lines = iter(lines)
+    width = None
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        i = start
+        start += len(chunk)
+
+        # building that many small lists and tuples triggers the garbage
+        # collector over and over for nothing
+        collect = gc.isenabled()
+        gc.disable()
+        try:
+            rows = list(map(split, chunk))
+            if width is None:
+                width = len(rows[0])
+            if set(map(len, rows)) != set([width]):
+                if not quiet:
+                    n, row = next((n, row) for n, row in enumerate(rows)
+                                  if len(row) != width)
+                    raise ValueError("Line %s has %s fields instead of %s"
+                                     % (i + n, len(row), width))
+                kept = [n for n, row in enumerate(rows) if len(row) == width]
+                chunk = [chunk[n] for n in kept]
+                rows = [rows[n] for n in kept]
+
+            arrays = []
+            for n, column in enumerate(zip(*rows)):
+                dtype = schema[n][1] if n < len(schema) else None
+                arrays.append(numpy.array(column, dtype=dtype or None))
+        finally:
+            if collect:
+                gc.enable()
+
+        if chunk:
+            yield chunk, i, Columns(arrays, names)
+
+
+class CodeCache(object):
+    """ On disk cache of compiled code, to skip parsing statements we
+        already ran.
+
+        Entries are marshalled values stored under $XDG_CACHE_HOME/pyped,
+        keyed by a hash of the source, the Python version and whatever
+        changes the compilation. Reading an entry touches it, and the least
+        recently used entries are removed when the cache grows over
+        max_size bytes.
+
+        The cache is an optimization only: any IO error is ignored.
+    """
+
+    max_size = 16 * 1024 * 1024
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+                os.path.expanduser('~'), '.cache')
+            directory = os.path.join(directory, 'pyped')
+        self.directory = directory
+        if max_size is not None:
+            self.max_size = max_size
+
+    def key(self, *parts):
+        """ Return the cache key for these compilation parameters """
+        import hashlib
+        parts = (sys.version, __VERSION__) + parts
+        return hashlib.sha1(repr(parts).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        """ Return the cached value, or None if there is none """
+        import marshal
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                value = marshal.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        return value
+
+    def set(self, key, value):
+        """ Store a value, then evict old entries if the cache is too big """
+        import marshal
+        path = os.path.join(self.directory, key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp = '%s.%s.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                marshal.dump(value, f)
+            os.rename(tmp, path)
+            self.evict()
+        except (IOError, OSError, ValueError):
+            pass
+
+    def evict(self):
+        """ Remove the least recently used entries above max_size """
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue  # removed by another pyp process
+            entries.append((info.st_mtime, info.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entry_size
+
+
+def compile_statement(statement, filename, mode='exec', encoding='utf8',
+                      quiet=False, cache=None):
+    """ Compile a statement once so it can be run on every line.
+
+        The source is registered in linecache under `filename`, so
+        tracebacks show the faulty statement. In quiet mode, a statement
+        that can't be compiled is returned as None.
+
+        If a CodeCache is passed, the code object is read from it when
+        possible, and stored in it otherwise.
+    """
+    try:
+        statement = statement.decode(encoding)
+    except AttributeError:
+        pass  # not bytes
+
+    linecache.cache[filename] = (len(statement), None,
+                                 statement.splitlines(True), filename)
+
+    if cache is not None:
+        key = cache.key(statement, filename, mode)
+        code = cache.get(key)
+        if code is not None:
+            return code
+
+    try:
+        code = compile(statement, filename, mode)
+    except SyntaxError:
+        if not quiet:
+            raise
+        return None
+
+    if cache is not None:
+        cache.set(key, code)
+    return code
+
+
+def compile_reduce(expression, encoding='utf8', cache=None):
+    """ Compile a --reduce expression using 'a' and 'b' into the code of a
+        lambda merging two values.
+    """
+    try:
+        expression = expression.decode(encoding)
+    except AttributeError:
+        pass  # not bytes
+    return compile_statement("lambda a, b: (%s)" % expression, '<pyp:reduce>',
+                             'eval', encoding, cache=cache)
+
+
+# Names that only make sense if the statements run at the module level
+UNFUSABLE_NAMES = frozenset(('locals', 'vars', 'globals', 'dir', 'exec',
+                             'eval', 'execfile'))
+
+
+class NodeVisitor(object):
+    """ ast.NodeVisitor, which doesn't need ast to be imported until a tree
+        is visited
+    """
+
+    def visit(self, node):
+        name = 'visit_' + node.__class__.__name__
+        return getattr(self, name, self.generic_visit)(node)
+
+    def generic_visit(self, node):
+        import ast
+        for child in ast.iter_child_nodes(node):
+            self.visit(child)
+
+
+class FusionChecker(NodeVisitor):
+    """ Look for constructs that would behave differently if the statements
+        were run as the body of a function instead of in the context globals.
+
+        Anything binding a name is such a construct, since the name would
+        become a local instead of being visible to the next lines and to
+        the "after" statement.
+    """
+
+    fusable = True
+
+    def reject(self, node):
+        self.fusable = False
+
+    visit_Global = visit_Import = visit_ImportFrom = reject
+    visit_FunctionDef = visit_ClassDef = reject
+    visit_Nonlocal = visit_AsyncFunctionDef = visit_NamedExpr = reject
+
+    def visit_Name(self, node):
+        import ast
+        if not isinstance(node.ctx, ast.Load) or node.id in UNFUSABLE_NAMES:
+            self.fusable = False
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.fusable = False
+        self.generic_visit(node)
+
+    def visit_comprehension(self, node):
+        # the target of a comprehension is local to the comprehension
+        self.visit(node.iter)
+        for condition in node.ifs:
+            self.visit(condition)
+
+
+def fields_usage(sources, mode='exec'):
+    """ Tell how the statements use the fields of the line, 'f'.
+
+        Return None if they don't use them at all, the highest index if they
+        only get fields at constant positive indexes, like "f[0] + f[2]",
+        or -1 if they need them all.
+    """
+    import ast
+    names = subscripts = 0
+    highest = 0
+    for source in sources:
+        try:
+            tree = ast.parse(source, mode=mode)
+        except SyntaxError:
+            return -1
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if node.id in UNFUSABLE_NAMES:
+                    return -1
+                names += node.id == 'f'
+            elif (isinstance(node, ast.Subscript)
+                    and isinstance(node.value, ast.Name)
+                    and node.value.id == 'f'):
+                index = node.slice
+                if isinstance(index, getattr(ast, 'Index', ())):
+                    index = index.value # python < 3.9
+                try:
+                    index = ast.literal_eval(index)
+                except ValueError:
+                    return -1
+                if type(index) is not int or index < 0:
+                    return -1
+                subscripts += 1
+                highest = max(highest, index)
+    if not names:
+        return None
+    if names != subscripts:
+        return -1
+    return highest
+
+
+# Inline flags applying to the whole pattern, like (?i), unlike (?i:...)
+GLOBAL_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+def filter_regex(source, multiline=False, cache=None):
+    """ Return a compiled regex matching the lines a simple -f expression
+        is true for, or None if the expression is not that simple.
+
+        The expression can be "'a' in x", "x.startswith('a')",
+        "x.endswith('a')", "re.search(r'a', x)", "re.match(r'a', x)",
+        "re.fullmatch(r'a', x)", or several of them joined with "or".
+
+        In multiline mode, the regex can be searched in a block of lines:
+        only literals are accepted then, and ^ and $ anchor them to the
+        lines.
+
+        If a CodeCache is passed, the pattern is read from it when
+        possible, so the expression isn't parsed again, and stored in it
+        otherwise.
+    """
+    flags = re.MULTILINE if multiline else 0
+    if cache is not None:
+        key = cache.key(source, '<pyp:filter>', multiline)
+        pattern = cache.get(key)
+        if pattern is not None:
+            # False means the expression is not that simple
+            return re.compile(pattern, flags) if pattern else None
+
+    pattern = filter_pattern(source, multiline)
+    if cache is not None:
+        cache.set(key, pattern or False)
+    return None if pattern is None else re.compile(pattern, flags)
+
+
+def filter_pattern(source, multiline=False):
+    """ Return the pattern of filter_regex(), or None """
+    import ast
+
+    def is_line(node):
+        return isinstance(node, ast.Name) and node.id == 'x'
+
+    def strings(node, tuples=False):
+        """ Return the string constants of node, or None """
+        try:
+            value = ast.literal_eval(node)
+        except ValueError:
+            return None
+        values = value if tuples and isinstance(value, tuple) else (value,)
+        if not values or not all(isinstance(value, text_type)
+                                 for value in values):
+            return None
+        return values
+
+    start, end = ('^', '$') if multiline else (r'\A', r'\Z')
+    try:
+        tree = ast.parse(source.strip(), mode='eval').body
+    except SyntaxError:
+        return None
+    tests = [tree]
+    if isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.Or):
+        tests = tree.values
+
+    alternatives = []
+    literals = []
+    groups = 0
+    for test in tests:
+        if (isinstance(test, ast.Compare) and len(test.ops) == 1
+                and isinstance(test.ops[0], ast.In)
+                and is_line(test.comparators[0])):
+            # 'a' in x
+            values = strings(test.left)
+            if values is None:
+                return None
+            literals.extend(values)
+            alternatives.append(re.escape(values[0]))
+            continue
+
+        if (not isinstance(test, ast.Call) or test.keywords
+                or not isinstance(test.func, ast.Attribute)):
+            return None
+        method, args = test.func, test.args
+        if (is_line(method.value) and len(args) == 1
+                and method.attr in ('startswith', 'endswith')):
+            # x.startswith('a') or x.startswith(('a', 'b'))
+            values = strings(args[0], tuples=True)
+            if values is None:
+                return None
+            literals.extend(values)
+            pattern = "|".join(re.escape(value) for value in values)
+            if method.attr == 'startswith':
+                alternatives.append("%s(?:%s)" % (start, pattern))
+            else:
+                alternatives.append("(?:%s)%s" % (pattern, end))
+        elif (isinstance(method.value, ast.Name) and method.value.id == 're'
+                and method.attr in ('search', 'match', 'fullmatch')
+                and len(args) == 2 and is_line(args[1]) and not multiline):
+            # re.search(r'a', x), that can be a real regex
+            values = strings(args[0])
+            # (?i) would apply to all the alternatives
+            if values is None or GLOBAL_FLAGS.search(values[0]):
+                return None
+            try:
+                # the groups of a pattern would be renumbered by the
+                # previous ones, breaking its backreferences
+                if groups and re.compile(values[0]).groups:
+                    return None
+                groups += re.compile(values[0]).groups
+            except re.error:
+                return None
+            alternatives.append({'search': "(?:%s)",
+                                 'match': r"\A(?:%s)",
+                                 'fullmatch': r"\A(?:%s)\Z"}[method.attr]
+                                % values[0])
+        else:
+            return None
+
+    # a line can't contain its separator, but a block can
+    if multiline and any("\n" in literal for literal in literals):
+        return None
+    pattern = "|".join(alternatives)
+    try:
+        re.compile(pattern, re.MULTILINE if multiline else 0)
+    except re.error:
+        return None
+    return pattern
+
+
+def fields_lazy_enough(sources, mode='exec'):
+    """ Tell if the statements only use 'f' in the ways a Fields object
+        behaves like a list: subscripts, len() and iterations.
+    """
+    import ast
+    for source in sources:
+        try:
+            tree = ast.parse(source, mode=mode)
+        except SyntaxError:
+            return False
+        supported = set()
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Subscript)
+                    and not isinstance(node.ctx, ast.Del)):
+                supported.add(id(node.value))
+            elif (isinstance(node, ast.Call) and len(node.args) == 1
+                    and isinstance(node.func, ast.Name)
+                    and node.func.id == 'len'):
+                supported.add(id(node.args[0]))
+            elif isinstance(node, (ast.For, ast.comprehension)):
+                supported.add(id(node.iter))
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Name) and node.id == 'f'
+                    and id(node) not in supported):
+                return False
+    return True
+
+
+class UnconditionalFields(NodeVisitor):
+    """ Look for 'f' in the parts of a statement that always run, skipping
+        the branches of conditions and the bodies of functions.
+    """
+
+    found = False
+
+    def visit_Name(self, node):
+        if node.id == 'f':
+            self.found = True
+
+    def visit_If(self, node):
+        self.visit(node.test)
+
+    visit_While = visit_IfExp = visit_If
+
+    def visit_BoolOp(self, node):
+        self.visit(node.values[0])
+
+    def visit_Try(self, node):
+        for statement in node.body:
+            self.visit(statement)
+
+    def visit_Lambda(self, node):
+        pass
+
+    visit_FunctionDef = visit_ClassDef = visit_Lambda
+
+    def visit_ListComp(self, node):
+        # only the first iterable of a comprehension is always evaluated
+        self.visit(node.generators[0].iter)
+
+    visit_GeneratorExp = visit_SetComp = visit_DictComp = visit_ListComp
+
+
+def fields_always_used(sources, mode='exec'):
+    """ Tell if the first statement gets the fields of every line """
+    import ast
+    try:
+        tree = ast.parse(sources[0], mode=mode)
+    except (SyntaxError, IndexError):
+        return False
+    finder = UnconditionalFields()
+    finder.visit(tree)
+    return finder.found
+
+
+# The names the fused function gets as fast locals instead of globals
+FUSED_LOCALS = frozenset(('x', 'i', 'f', 'F', 'j', 'row', 'r'))
+
+# Nested code that runs right away, in the scope of the fused function
+COMPREHENSIONS = frozenset(('<listcomp>', '<setcomp>', '<dictcomp>'))
+
+
+def outer_line_names(context, codes, before=None):
+    """ Return the names of FUSED_LOCALS that code running outside of the
+        fused function could read as globals: "before", the functions and
+        classes defined in the context, and what the statements define
+        without running it right away, like lambdas.
+    """
+    outer = [before]
+    for value in list(context.values()):
+        if isinstance(value, types.FunctionType):
+            values = [value]
+        elif isinstance(value, type):
+            values = [method for method in vars(value).values()
+                      if isinstance(method, types.FunctionType)]
+        else:
+            continue
+        outer.extend(function.__code__ for function in values
+                     if function.__globals__ is context)
+    for code in codes:
+        outer.extend(const for const in getattr(code, 'co_consts', ())
+                     if isinstance(const, types.CodeType)
+                     and const.co_name not in COMPREHENSIONS)
+    return FUSED_LOCALS.intersection(referenced_names(outer))
+
+
+def parse_statement(source, mode='exec'):
+    """ ast.parse() with the __future__ flags of this module, like the
+        statements compiled by compile_statement(), e.g: print() is a
+        function on Python 2 too.
+    """
+    import ast
+    return compile(source, '<pyp:fused>', mode, ast.PyCF_ONLY_AST)
+
+
+# The function fuse_statements() fills
+FUSED_TEMPLATE = ("def __pyp_line(x, i%s, __print=__pyp_print, "
+                  "__split=__pyp_split, __awk=__pyp_awk):\n"
+                  "    pass\n")
+
+
+def fuse_statements(sources, autoprint=False, filter_input=False,
+                    quiet=False, split=False, json=False, awk=False,
+                    csv_rows=False):
+    """ Synthesize one function running all the statements on a line.
+
+        The function takes 'x' and 'i' (and computes 'f' if split is set,
+        'F' if awk is set, or takes 'j' too if json is set, 'row' and 'r'
+        if csv_rows is set) as fast locals
+        instead of setting them in the context for each statement. It prints
+        the result of each expression in autoprint mode and prints 'x' if all
+        the expressions are true in filter mode.
+
+        Return the source of the function and its AST, or None if one of
+        the statements can't be safely run this way.
+    """
+    import ast
+    mode = 'eval' if autoprint or filter_input else 'exec'
+    checker = FusionChecker()
+    trees = []
+    lineno = 0
+    for source in sources:
+        tree = parse_statement(source, mode=mode)
+        checker.visit(tree)
+        if not checker.fusable:
+            return None
+        # line numbers match the concatenation of all the statements
+        ast.increment_lineno(tree, lineno)
+        lineno += len(source.splitlines()) or 1
+        trees.append(tree)
+
+    module = parse_statement(FUSED_TEMPLATE % ((", j" if json else "") +
+                                         (", row, r" if csv_rows else "")))
+    function = module.body[0]
+    body = []
+
+    if split:
+        body.extend(parse_statement("f = __split(x)").body)
+    if awk:
+        body.extend(parse_statement("F = __awk(x)").body)
+    for tree in trees:
+        if autoprint:
+            statements = parse_statement("__r = None\n"
+                                   "if __r is not None:\n"
+                                   "    __print(__r)\n").body
+            statements[0].value = tree.body
+        elif filter_input:
+            statements = parse_statement("if not None:\n"
+                                   "    return\n").body
+            statements[0].test.operand = tree.body
+        else:
+            statements = tree.body
+
+        if quiet:
+            guard = parse_statement("try:\n"
+                              "    pass\n"
+                              "except Exception:\n"
+                              "    pass\n").body[0]
+            guard.body = statements
+            if filter_input:
+                guard.handlers[0].body = parse_statement("return").body
+            statements = [guard]
+
+        body.extend(statements)
+
+    if filter_input:
+        body.extend(parse_statement("__print(x)").body)
+
+    function.body = body or function.body
+    return "\n".join(sources), ast.fix_missing_locations(module)
+
+
+def compile_fused(sources, autoprint=False, filter_input=False, quiet=False,
+                  split=False, cache=None, json=False, awk=False,
+                  csv_rows=False):
+    """ Compile the module defining the function built by fuse_statements().
+
+        Return None if the statements can't be fused.
+    """
+    name = '<pyp:fused>'
+    source = "\n".join(sources)
+    linecache.cache[name] = (len(source), None, source.splitlines(True), name)
+
+    if cache is not None:
+        # the statements, not their concatenation: each one gets its own
+        # guard in quiet mode
+        key = cache.key(tuple(sources), name, autoprint, filter_input, quiet,
+                        split, json, awk, csv_rows, FUSED_TEMPLATE)
+        code = cache.get(key)
+        if code is not None:
+            return code or None  # False means we can't fuse them
+
+    fused = fuse_statements(sources, autoprint, filter_input, quiet, split,
+                            json, awk, csv_rows)
+    code = fused and compile(fused[1], name, 'exec')
+
+    if cache is not None:
+        cache.set(key, code or False)
+    return code
+
+
+# The state of a worker process in parallel mode
+_worker = {}
+
+
+def _init_worker(statements, context, options, reader=None):
+    """ Run the "before" statement in a new worker process """
+    context = dict(context)
+    execute_statements([], additional_context=context,
+                       before=options.pop('before', None),
+                       quiet=options.get('quiet'),
+                       prelude=options.get('prelude'),
+                       cache=options.get('cache'))
+    _worker.update(statements=statements, context=context, options=options,
+                   reader=reader)
+
+
+def _count_worker(task):
+    """ Count the records in a range of the mapped stdin """
+    return _worker['reader'].count_records(*task)
+
+
+def _run_worker(task):
+    """ Run the statements on a batch of lines, return what they printed """
+    start, lines, separator = task
+    if isinstance(lines, tuple):
+        # a range of the mapped stdin, that the worker reads itself
+        lines = _worker['reader'].decode_range(*lines)
+    if separator is not None:
+        lines = ChunkReader(lines, separator)
+    binary = _worker['options'].get('binary')
+    stream = BytesIO() if binary else StringIO()
+    result = execute_statements(_worker['statements'], lines,
+                                additional_context=_worker['context'],
+                                start=start, output=Output(stream, binary=binary),
+                                **_worker['options'])
+    if _worker['options'].get('reduce'):
+        # the partial result of this chunk, merged by the parent
+        return result
+    return stream.getvalue()
+
+
+def uses_line_numbers(statements, after=None, context=None, **options):
+    """ Tell if the statements, "after", or code they may call, like what
+        "before" or the context define, may use 'i'
+    """
+    charset = options.get('stdin_charset') or 'utf8'
+    mode = ('eval' if options.get('autoprint') or options.get('filter_input')
+            or options.get('reduce') else 'exec')
+    try:
+        codes = [compile_statement(statement, '<pyp:stmt>', mode, charset,
+                                   cache=options.get('cache'))
+                 for statement in statements]
+        for statement, name in ((options.get('before'), '<pyp:before>'),
+                                (after, '<pyp:after>')):
+            if statement:
+                codes.append(compile_statement(statement, name, 'exec',
+                                               charset,
+                                               cache=options.get('cache')))
+    except SyntaxError:
+        return True
+    names = referenced_names(codes)
+    return ('i' in names or not names.isdisjoint(UNFUSABLE_NAMES)
+            or 'i' in outer_line_names(context or {}, []))
+
+
+def execute_parallel(statements, stdin, jobs, ordered=True,
+                     additional_context=None, after=None, output=None,
+                     batch_size=10000, range_size=32 * 1024 * 1024,
+                     **options):
+    """ Run the statements on each line of stdin in `jobs` processes.
+
+        stdin is read in the parent process and sent by chunks to the
+        workers, each with its own context. The "before" statement runs
+        once in each worker, and the "after" statement once in the parent,
+        when all the lines are processed. What the workers print is sent
+        back to the parent, in the order of the input if `ordered` is True,
+        or as soon as it's ready otherwise.
+
+        If stdin is a file mapped in memory, the workers get ranges of
+        about range_size bytes and read them from the mapping themselves,
+        so no data goes through the parent. Lines are then only counted,
+        by the workers too, if the statements use 'i'.
+    """
+    import multiprocessing
+
+    context = {} if additional_context is None else additional_context
+    output = output or Output(binary=options.get('binary'))
+    rstrip = options.get('rstrip', "\n")
+
+    # the last batch sent, and the number of lines
+    state = {'last': None, 'count': 0}
+
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            # let the workers inherit the context instead of pickling it
+            pool_factory = multiprocessing.get_context('fork').Pool
+            forked = True
+        except ValueError:
+            pool_factory = multiprocessing.get_context().Pool
+            forked = False
+    else:
+        pool_factory = multiprocessing.Pool
+        forked = os.name == 'posix'
+
+    # the workers can only share the mapping if they are forked
+    reader = None
+    if forked and getattr(stdin, 'map', None) is not None:
+        reader = stdin
+        ranges = reader.ranges(max(min(range_size, len(reader.map) // jobs),
+                                   reader.block_size))
+        # the number of lines in each range, if we need them
+        counts = [None] * len(ranges)
+
+    def tasks():
+        """ Yield (index of the first line, chunk, separator) """
+        start = 1
+        if reader is not None:
+            for (begin, end), count in zip(ranges, counts):
+                yield start, (begin, end), reader.separator
+                if count is not None:
+                    start += count
+            if ranges:
+                # the last record, for "after", whatever its length
+                first, end = ranges[0][0], ranges[-1][1]
+                separator = reader.raw_separator
+                stop = end
+                if reader.map[end - len(separator):end] == separator:
+                    stop -= len(separator)
+                begin = reader.map.rfind(separator, first, stop)
+                begin = first if begin == -1 else begin + len(separator)
+                state['last'] = ChunkReader(reader.decode_range(begin, end),
+                                            reader.separator)
+            if counts and counts[-1] is None:
+                start = None # lines were not counted
+        elif hasattr(stdin, 'chunks'):
+            # send the raw chunks, the parent doesn't even split lines
+            separator = stdin.separator
+            for chunk in stdin.chunks():
+                yield start, chunk, separator
+                start += chunk.count(separator)
+                if not chunk.endswith(separator):
+                    start += 1
+                state['last'] = ChunkReader(chunk, separator)
+        else:
+            lines = iter(stdin)
+            while True:
+                batch = list(islice(lines, batch_size))
+                if not batch:
+                    break
+                yield start, batch, None
+                start += len(batch)
+                state['last'] = batch
+        state['count'] = start and start - 1
+
+    reduce = options.get('reduce')
+    reduced = []
+
+    pool = pool_factory(jobs, _init_worker,
+                        (statements, context, options, reader))
+    try:
+        if reader is not None and uses_line_numbers(statements, after,
+                                                    context, **options):
+            counts = pool.map(_count_worker, ranges)
+
+        if reduce:
+            # the parent merges the partial results, maybe with a function
+            # defined in "before"
+            execute_statements([], additional_context=context,
+                               before=options.get('before'),
+                               quiet=options.get('quiet'),
+                               prelude=options.get('prelude'),
+                               cache=options.get('cache'))
+            code = compile_reduce(reduce, options.get('stdin_charset') or
+                                  'utf8', options.get('cache'))
+            if options.get('prelude'):
+                load_prelude(context, [code])
+            merge = eval(code, context)
+
+        results = pool.imap if ordered else pool.imap_unordered
+        for n, data in enumerate(results(_run_worker, tasks())):
+            if reader is not None:
+                # the pool takes all the ranges right away: count them as
+                # read when they are processed instead, for --progress.
+                # Unordered, the ranges being about the same size, n of
+                # them done is close enough.
+                reader.advance(ranges[n][1])
+            if not reduce:
+                output.write(data)
+            elif data is not None:
+                if reduced:
+                    reduced[0] = merge(reduced[0], data)
+                else:
+                    reduced.append(data)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if reduce:
+        context['r'] = reduced[0] if reduced else None
+
+    # the last line, for the "after" statement
+    if state['last'] is not None:
+        last = state['last']
+        if isinstance(last, ChunkReader):
+            last = list(last.lines(rstrip))[-1]
+        else:
+            last = last[-1]
+            if not options.get('binary'):
+                try:
+                    last = last.decode(options.get('stdin_charset') or 'utf8')
+                except AttributeError:
+                    pass # not bytes
+            last = last.rstrip(rstrip)
+        context['x'] = last
+        if state['count'] is not None:
+            context['i'] = state['count']
+        # and its fields, like run_lines() sets them
+        split = options.get('split')
+        if split:
+            try:
+                split = (split if options.get('binary') else
+                         split.decode(options.get('stdin_charset') or 'utf8'))
+            except AttributeError:
+                pass # not bytes
+            split = make_splitter(split)
+            context['f'] = split(last)
+        if 'F' not in context or isinstance(context['F'], AwkFields):
+            context['F'] = (AwkFields(last, split=split) if split
+                            else AwkFields(last))
+
+    # as if it was the end of execute_statements() in the parent
+    execute_statements([], additional_context=context, after=after,
+                       output=output, quiet=options.get('quiet'),
+                       prelude=options.get('prelude'),
+                       cache=options.get('cache'))
+
+    if reduce:
+        return context['r']
+
+
+class Stats(object):
+    """ Counters and timers of a run, for --stats.
+
+        Nothing is timed unless a Stats instance is passed to
+        execute_statements(), which then wraps what needs to be timed.
+    """
+
+    clock = getattr(time, 'perf_counter', time.time)
+
+    def __init__(self):
+        self.start = self.clock()
+        self.end = None
+        self.lines = 0
+        self.bytes = 0
+        self.exceptions = 0
+        self.names = []
+        self.timers = {}
+
+    def timer(self, name):
+        """ Return the [calls, seconds] of a phase, creating it if needed """
+        if name not in self.timers:
+            self.names.append(name)
+            self.timers[name] = [0, 0]
+        return self.timers[name]
+
+    def timed(self, name, function):
+        """ Wrap function so that its calls are timed in the name phase """
+        timer = self.timer(name)
+        clock = self.clock
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer[0] += 1
+                timer[1] += clock() - start
+        return timed
+
+    def timed_code(self, function, labels):
+        """ Wrap eval() or exec() to time each code object under its label """
+        timers = dict((code, self.timer(label))
+                      for code, label in labels.items())
+        clock = self.clock
+
+        def timed(code, context):
+            start = clock()
+            try:
+                return function(code, context)
+            finally:
+                timer = timers[code]
+                timer[0] += 1
+                timer[1] += clock() - start
+        return timed
+
+    def timed_iter(self, name, iterable):
+        """ Count the items of iterable, timing how long they take to get """
+        timer = self.timer(name)
+        clock = self.clock
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                timer[1] += clock() - start
+                return
+            timer[0] += 1
+            timer[1] += clock() - start
+            self.lines += 1
+            yield item
+
+    def summary(self):
+        """ Return the stats as a dict, with the phases in the order a line
+            goes through them
+        """
+        seconds = (self.end or self.clock()) - self.start
+        order = {'read': 0, 'split': 1, 'output': 3}
+        names = sorted(self.names, key=lambda name: order.get(name, 2))
+        return {
+            'seconds': seconds,
+            'lines': self.lines,
+            'bytes': self.bytes,
+            'lines_per_sec': self.lines / seconds if seconds else 0,
+            'mb_per_sec': self.bytes / 1024 / 1024 / seconds if seconds else 0,
+            'exceptions': self.exceptions,
+            'phases': [{'name': name, 'calls': self.timers[name][0],
+                        'seconds': self.timers[name][1]}
+                       for name in names],
+        }
+
+    def report(self, stream, format='table'):
+        """ Write the stats on stream, as a table or as JSON """
+        summary = self.summary()
+        if format == 'json':
+            stream.write(json.dumps(summary, sort_keys=True) + "\n")
+            return
+        stream.write("pyp: %(lines)s lines, %(bytes)s bytes in %(seconds).3fs "
+                     "(%(lines_per_sec).0f lines/s, %(mb_per_sec).1f MB/s), "
+                     "%(exceptions)s exceptions\n" % summary)
+        width = max([len(phase['name']) for phase in summary['phases']]
+                    + [5])
+        stream.write("pyp: %-*s %10s %10s %12s\n" % (width, "phase", "calls",
+                                                     "seconds", "us per call"))
+        for phase in summary['phases']:
+            per_call = phase['seconds'] / phase['calls'] if phase['calls'] else 0
+            stream.write("pyp: %-*s %10s %10.3f %12.2f\n"
+                         % (width, phase['name'], phase['calls'],
+                            phase['seconds'], per_call * 1000000))
+
+
+class SamplingProfiler(object):
+    """ Sample the stack of the thread running the statements, for --profile.
+
+        Like a cProfile.Profile, it's started with enable() and stopped with
+        disable(), but it only looks at the stack every `interval` seconds,
+        from another thread, so the statements run at nearly full speed and
+        the samples tell which line of them is hot.
+    """
+
+    def __init__(self, interval=0.001):
+        import threading
+        self.interval = interval
+        self.samples = 0
+        self.stacks = {}
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def enable(self):
+        import threading
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.sample,
+                                       args=(threading.current_thread().ident,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def disable(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def sample(self, ident):
+        """ Count the stacks of the ident thread until disabled """
+        stacks = self.stacks
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                # a frame that just started has no line number yet
+                stack.append((code.co_filename, code.co_name,
+                              frame.f_lineno or code.co_firstlineno))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def lines(self):
+        """ Return the [(samples, filename, line number)] of the statements,
+            the hottest first. A sample counts for the innermost line of
+            the statements in the stack, the time spent in what they call
+            included.
+        """
+        lines = {}
+        for stack, count in self.stacks.items():
+            for filename, name, lineno in reversed(stack):
+                if filename.startswith('<pyp:'):
+                    lines[filename, lineno] = lines.get((filename, lineno),
+                                                        0) + count
+                    break
+        return sorted(((count, filename, lineno)
+                       for (filename, lineno), count in lines.items()),
+                      key=lambda line: (-line[0], line[1], line[2]))
+
+    def collapsed(self):
+        """ Return the stacks as lines of "frame;frame;frame samples", the
+            input of flamegraph.pl and speedscope
+        """
+        stacks = {}
+        for stack, count in self.stacks.items():
+            frames = []
+            for filename, name, lineno in stack:
+                if filename.startswith('<pyp:'):
+                    # the line of the statements, not the module
+                    frames.append("%s:%s" % (filename, lineno))
+                else:
+                    frames.append("%s (%s)" % (name,
+                                               os.path.basename(filename)))
+            frames = ";".join(frames)
+            stacks[frames] = stacks.get(frames, 0) + count
+        return ["%s %s" % item for item in sorted(stacks.items())]
+
+    def report(self, stream, format='table'):
+        """ Write the profile on stream, as a table of the hottest lines of
+            the statements, or as collapsed stacks
+        """
+        if format == 'collapsed':
+            for line in self.collapsed():
+                stream.write(line + "\n")
+            return
+        lines = self.lines()
+        total = self.samples or 1
+        in_statements = sum(count for count, filename, lineno in lines)
+        stream.write("pyp: %s samples, %.1f%% in the statements\n"
+                     % (self.samples, in_statements * 100 / total))
+        stream.write("pyp: %8s %6s  line\n" % ("samples", "%"))
+        for count, filename, lineno in lines:
+            source = linecache.getline(filename, lineno).strip()
+            stream.write("pyp: %8s %6.1f  %s:%s  %s\n"
+                         % (count, count * 100 / total, filename, lineno,
+                            source))
+
+
+def format_duration(seconds):
+    """ Format seconds as h:mm:ss """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Progress(object):
+    """ Report on stream how much of stdin was read, for --progress.
+
+        A thread looks at the counters of the reader every `interval`
+        seconds, so nothing is added to the processing of each line. If
+        stdin is a regular file, its size gives the percentage done and the
+        time left.
+
+        On a terminal, the report is updated in place.
+    """
+
+    clock = getattr(time, 'perf_counter', time.time)
+
+    def __init__(self, reader, stream, interval=1):
+        import threading
+        self.reader = reader
+        self.stream = stream
+        self.interval = interval
+        self.total = None
+        try:
+            fd = reader.fd
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                self.total = (os.fstat(fd).st_size
+                              - os.lseek(fd, 0, os.SEEK_CUR))
+        except (AttributeError, EnvironmentError):
+            pass # not a file descriptor
+        isatty = getattr(stream, 'isatty', None)
+        self.inplace = bool(isatty and isatty())
+        self.start = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def enable(self):
+        import threading
+        self.start = self.clock()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.update)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def disable(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            self.report(final=True)
+
+    def update(self):
+        """ Report the progress until disabled """
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def status(self):
+        """ Return the progress as a line of text """
+        seconds = self.clock() - self.start
+        lines = self.reader.records_read
+        size = self.reader.bytes_read
+        status = "pyp: "
+        if lines:
+            status += "%s lines, " % lines
+        status += "%.1f MB in %s" % (size / 1024 / 1024,
+                                     format_duration(seconds))
+        if seconds:
+            status += " ("
+            if lines:
+                status += "%.0f lines/s, " % (lines / seconds)
+            status += "%.1f MB/s)" % (size / 1024 / 1024 / seconds)
+        if self.total:
+            status += ", %.1f%%" % min(size * 100 / self.total, 100)
+            if size and size < self.total:
+                left = (self.total - size) * seconds / size
+                status += ", %s left" % format_duration(left)
+        return status
+
+    def report(self, final=False):
+        status = self.status()
+        if self.inplace:
+            # erase what is left of a longer previous status
+            status = "\r" + status + "\033[K"
+            if final:
+                status += "\n"
+        else:
+            status += "\n"
+        self.stream.write(status)
+        self.stream.flush()
 
-if not PY3:
-    from itertools import imap, izip, izip_longest
 
 # we need a function to make a setup.py entry point and unit tests
 def execute_statements(statements, stdin=None, additional_context=None,
                        quiet=False, iterable=False, autoprint=False,
                        filter_input=False, stdin_charset='utf8', before=None,
                        after=None, split=None, rstrip="\n", full=False,
-                       parse_json=False):
-
-    for options in itertools.combinations((full, parse_json, iterable), 2):
+                       parse_json=False, prelude=False, import_log=None,
+                       cache=None, output=None, binary=False, jobs=1,
+                       ordered=True, start=1, reduce=None,
+                       json_stream=None, json_lines=False, columns=False,
+                       schema=None, csv_dialect=None, header=False,
+                       window=None, window_bytes=None, stats=None,
+                       profiler=None):
+
+    streaming = json_stream is not None
+    decode_json = streaming or json_lines
+    for options in itertools.combinations((full, parse_json, iterable,
+                                           streaming, json_lines, columns,
+                                           csv_dialect), 2):
         if all(options):
             raise ValueError("You can only choose one of the following at the "
                              "same time : full stdin, stdin as iterable or "
                              "parse stdin as JSON.")
 
-    if split and (parse_json or iterable):
+    if split and (parse_json or iterable or decode_json):
         raise ValueError("You can't mix splitting stdin and parsing it as JSON "
                          "getting it as an iterable.")
 
+    if csv_dialect and (split or binary):
+        raise ValueError("CSV rows are split by the csv module, as text.")
+
+    windowed = window is not None or window_bytes is not None
+    if windowed and (iterable or full or parse_json or decode_json or columns
+                     or csv_dialect):
+        raise ValueError("A window can only slide on lines, not on the full "
+                         "stdin, JSON, CSV rows or columns.")
+
+    if reduce and (iterable or full or parse_json or filter_input
+                   or len(statements) != 1):
+        raise ValueError("Reducing needs one expression to run on each line "
+                         "and can't be mixed with filtering, getting stdin "
+                         "as an iterable, full or as JSON.")
+
+    if jobs > 1 and stdin and not (iterable or full or parse_json or
+                                   streaming or columns or csv_dialect or
+                                   windowed or stats or profiler):
+        return execute_parallel(statements, stdin, jobs, ordered,
+                                additional_context, after, output,
+                                quiet=quiet, autoprint=autoprint,
+                                filter_input=filter_input,
+                                stdin_charset=stdin_charset, before=before,
+                                split=split, rstrip=rstrip, prelude=prelude,
+                                cache=cache, binary=binary, reduce=reduce,
+                                json_lines=json_lines)
+
     in_encoding = (getattr(stdin, 'encoding', None) or stdin_charset
                      or sys.stdin.encoding)
     if in_encoding in ('ascii', None, ''):
         in_encoding = 'utf8'
 
-    context = additional_context or {}
+    context = {} if additional_context is None else additional_context
+
+    # the last lines, up to the current one
+    if window is not None:
+        context['w'] = deque(maxlen=window)
+    elif window_bytes is not None:
+        context['w'] = ByteWindow(window_bytes)
+
+    # in binary mode, stdin is not decoded and bytes are printed as is
+    if binary:
+        output = output or Output(binary=True)
+        if isinstance(rstrip, text_type):
+            rstrip = rstrip.encode(in_encoding)
+        if isinstance(split, text_type):
+            split = split.encode(in_encoding)
+
+    # printed rows go through a csv writer sharing the output buffer
+    if csv_dialect:
+        import csv
+        output = output or Output()
+        writer = csv.writer(output, csv_dialect, lineterminator="\n")
+
+    # an Output instance replaces print() for the statements too
+    _print = output or print
+    if output is not None:
+        context['print'] = output
+
+    # filtering a JSON stream outputs the matching values as JSON lines,
+    # and so does printing expressions results on JSON lines
+    if (filter_input and streaming) or (autoprint and json_lines):
+        _print_value = _print
+        _dumps = json_codec()[1]
+
+        def _print(value):
+            _print_value(_dumps(value))
+
+    if csv_dialect:
+        _print_value = _print
+
+        def _print(value):
+            if isinstance(value, Row):
+                value = value.row
+            if isinstance(value, (list, tuple)):
+                writer.writerow(value)
+            else:
+                _print_value(value)
+
+    # when reducing, the results of the expression are merged instead of
+    # being printed
+    if reduce:
+        reduced = []
+
+        def _print(value):
+            if reduced:
+                reduced[0] = merge(reduced[0], value)
+            else:
+                reduced.append(value)
+
+    if stats is not None:
+        _print = stats.timed('output', _print)
+        if output is not None:
+            context['print'] = stats.timed('output', output)
+
+    sources = []
+    for statement in statements:
+        try:
+            statement = statement.decode(in_encoding)
+        except AttributeError:
+            pass # not bytes
+        sources.append(statement)
+
+    # Parse and compile everything once, not once per line
+    mode = 'eval' if autoprint or filter_input or reduce else 'exec'
+    codes = [compile_statement(source, '<pyp:stmt %s>' % n, mode,
+                               in_encoding, quiet, cache)
+             for n, source in enumerate(sources, 1)]
+    merge = None
+    if reduce:
+        merge = compile_reduce(reduce, in_encoding, cache)
+    if before:
+        before = compile_statement(before, '<pyp:before>', 'exec',
+                                   in_encoding, quiet, cache)
+    if after:
+        after = compile_statement(after, '<pyp:after>', 'exec',
+                                  in_encoding, quiet, cache)
+
+    # only import the prelude names the statements actually use
+    if prelude:
+        load_prelude(context, codes + [before, after, merge], import_log)
+
+    # with stats, each statement is timed through these
+    _eval, _exec = eval, exec_
+    if stats is not None:
+        labels = dict((code, "stmt %s: %s" % (n, " ".join(source.split())[:30]))
+                      for n, (code, source) in enumerate(zip(codes, sources), 1)
+                      if code is not None)
+        _eval = stats.timed_code(eval, labels)
+        _exec = stats.timed_code(exec_, labels)
 
     def execute_all(context):
         """ Execute all python statements/expressions in the given context """
-        for statement in statements:
-            try:
-                statement = statement.decode(in_encoding)
-            except AttributeError:
-                pass # note a byte
+        for code in codes:
+            if code is None:
+                continue  # quiet mode and the statement is invalid
             try:
                 # command is an expression you need to print
-                if autoprint:
-                    res = eval(statement, context)
+                if autoprint or reduce:
+                    res = _eval(code, context)
                     if res is not None:
-                        print(res)
+                        _print(res)
                 # execute as is
                 else:
-                    exec_(statement, context)
+                    _exec(code, context)
             except Exception as e:
+                if stats is not None:
+                    stats.exceptions += 1
                 if not quiet:
                     raise e
 
-    try:
-        if before:
+    def process_line(line, i, j=None):
+        """ Run the statements on one line, through the context """
+        if split_fields:
+            context['f'] = split_fields(line)
+        if awk_fields:
+            context['F'] = awk_fields(line)
+        context['x'] = line
+        context['i'] = i
+        if decode_json:
+            context['j'] = j
+        execute_all(context)
+
+    def filter_line(line, i, j=None):
+        """ Print the line if all the expressions are true for it """
+        if split_fields:
+            context['f'] = split_fields(line)
+        if awk_fields:
+            context['F'] = awk_fields(line)
+        context['x'] = line
+        context['i'] = i
+        if decode_json:
+            context['j'] = j
+        for code in codes:
+            try:
+                if not _eval(code, context):
+                    break
+            except Exception as e:
+                if stats is not None:
+                    stats.exceptions += 1
+                if not quiet:
+                    raise e
+                break
+        else:
+            _print(context['x'])
+
+    def simple_filter():
+        """ Return the regex the -f expression can be replaced with, or
+            None, and whether it can be searched in whole chunks of stdin
+        """
+        if (len(codes) != 1 or codes[0] is None or stdin is None
+                or binary or after or windowed or parse_json
+                or stats is not None or profiler is not None):
+            return None, False
+        # "re" may be something else than the module in the context
+        if 're' in referenced_names(codes) and context.get('re') is not re:
+            return None, False
+        if (hasattr(stdin, 'chunks') and stdin.separator == "\n"
+                and rstrip == "\n"):
+            regex = filter_regex(sources[0], multiline=True, cache=cache)
+            if regex is not None:
+                return regex, True
+        return filter_regex(sources[0], cache=cache), False
+
+    def match_line(search, line, i):
+        """ Print the line if search() matches it """
+        if search(line):
+            _print(line)
+
+    def scan_chunks(search):
+        """ Print the lines of stdin search() matches, searching whole
+            chunks of lines instead of splitting them
+        """
+        for chunk in stdin.chunks():
+            # the lines are not split, but --progress still counts them
+            stdin.records_read += chunk.count("\n")
+            if chunk and not chunk.endswith("\n"):
+                stdin.records_read += 1
+            matched = []
+            position, size = 0, len(chunk)
+            while position < size:
+                match = search(chunk, position)
+                if match is None:
+                    break
+                begin = chunk.rfind("\n", 0, match.start()) + 1
+                end = chunk.find("\n", match.start())
+                if end == -1:
+                    end = size # the last line, without line break
+                matched.append(chunk[begin:end])
+                position = end + 1
+                if (len(matched) == 64 and position < size
+                        and chunk.count("\n", 0, position) < 256):
+                    # most lines match, splitting them all is faster
+                    lines = chunk[position:].split("\n")
+                    if chunk.endswith("\n"):
+                        lines.pop()
+                    matched.extend(filter(search, lines))
+                    break
+            if matched:
+                _print("\n".join(matched))
+
+    def process_chunk(lines, i, cols):
+        """ Run the statements once on a chunk of lines and their columns """
+        context['x'] = lines
+        context['i'] = i
+        context['cols'] = cols
+        execute_all(context)
+
+    def filter_chunk(lines, i, cols):
+        """ Print the lines of the chunk for which all the expressions,
+            giving an array of booleans, are true
+        """
+        import numpy
+        context['x'] = lines
+        context['i'] = i
+        context['cols'] = cols
+        mask = numpy.ones(len(lines), dtype=bool)
+        for code in codes:
             try:
+                mask &= _eval(code, context)
+            except Exception as e:
+                if stats is not None:
+                    stats.exceptions += 1
+                if not quiet:
+                    raise e
+                return
+        for line in itertools.compress(lines, mask):
+            _print(line)
+
+    def read_lines(strip=None):
+        """ Yield each line of stdin, decoded and right stripped of strip,
+            default to rstrip
+        """
+        strip = rstrip if strip is None else strip
+        if hasattr(stdin, 'lines'):
+            # a RecordReader does it in bulk
+            for line in stdin.lines(strip):
+                yield line
+            return
+        for line in stdin:
+            if not binary:
                 try:
-                    before = before.decode(in_encoding)
+                    line = line.decode(in_encoding)
                 except AttributeError:
-                    pass  # not bytes
+                    pass # note bytes
+            yield line.rstrip(strip)
+
+    def slide(lines):
+        """ Add each line to the window before yielding it """
+        append = context['w'].append
+        for line in lines:
+            append(line)
+            yield line
+
+    def run_lines(process, lines=None):
+        """ Pass each line of stdin, or of lines, to process() """
+        line = i = None
+        lines = read_lines() if lines is None else lines
+        if stats is not None:
+            lines = stats.timed_iter('read', lines)
+        if windowed:
+            lines = slide(lines)
+        try:
+            for i, line in enumerate(lines, start):
+                process(line, i)
+        finally:
+            # the fused function doesn't touch the context, but the
+            # "after" statement still expects the last line in it
+            if i is not None:
+                if split:
+                    context['f'] = make_splitter(splitter)(line)
+                if awk_fields:
+                    context['F'] = awk_fields(line)
+                if process is fused:
+                    context['x'] = line
+                    context['i'] = i
+
+    def run_records(process, records, names=('x', 'i', 'j')):
+        """ Pass each (x, i, j) record, or a record of the given names,
+            to process()
+        """
+        record = None
+        if stats is not None:
+            records = stats.timed_iter('read', records)
+        try:
+            for record in records:
+                process(*record)
+        finally:
+            if process is fused and record is not None:
+                context.update(zip(names, record))
+
+    # what the statements write to sys.stdout goes through the output
+    # buffer too, so it's in order with what they print
+    stdout = sys.stdout
+    if output is not None:
+        sys.stdout = output
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if before:
+            try:
                 exec_(before, context)
             except Exception as e:
                 if not quiet:
                     raise e
+        if merge:
+            # the expression may use something defined in "before"
+            merge = eval(merge, context)
+        # only split the line as much as the statements need
+        split_fields = None
         if split:
             try:
-                splitter = split.decode(in_encoding)
+                splitter = split if binary else split.decode(in_encoding)
             except AttributeError:
                 splitter = split # not bytes
+            usage = fields_usage(sources, mode)
+            outer = 'f' in outer_line_names(context, codes, before)
+            if outer:
+                usage = -1 # code defined outside of the statements uses them
+            if usage is not None and usage >= 0:
+                split_fields = make_splitter(splitter, usage + 1)
+            elif usage is not None and (
+                    fields_always_used(sources, mode)
+                    or not fields_lazy_enough(sources, mode) or outer):
+                # a real list, e.g: for f.sort() or json.dumps(f)
+                split_fields = make_splitter(splitter)
+            elif usage is not None:
+                # the fields may not be used for all lines, so wait for it
+                split_fields = partial(Fields, split=make_splitter(splitter))
+
+        # 'F' gives AWK-like fields, split on whitespace unless -s is used
+        # unless there is already one, e.g: defined by "before"
+        awk_fields = None
+        names = referenced_names(codes + [after])
+        own = 'F' in context and not isinstance(context['F'], AwkFields)
+        if not own and ('F' in names
+                        or not names.isdisjoint(UNFUSABLE_NAMES)):
+            awk_fields = AwkFields
+            if split:
+                awk_fields = partial(AwkFields, split=make_splitter(splitter))
+
+        # run all the statements on a line with a single function call
+        # when it's safe to do so
+        fused = None
+        if stats is not None:
+            # time the steps of each line instead
+            if split_fields:
+                split_fields = stats.timed('split', split_fields)
+            if awk_fields:
+                awk_fields = stats.timed('split', awk_fields)
+        elif (profiler is None and not columns and None not in codes and
+                (filter_input or (stdin and not (iterable or full or
+                                                 parse_json))) and
+                not outer_line_names(context, codes, before)):
+            fused = compile_fused(sources, autoprint or bool(reduce),
+                                  filter_input, quiet, bool(split_fields),
+                                  cache, decode_json, bool(awk_fields),
+                                  bool(csv_dialect))
+        if fused:
+            namespace = {'__pyp_split': split_fields,
+                         '__pyp_awk': awk_fields,
+                         '__pyp_print': _print}
+            exec_(fused, context, namespace)
+            fused = namespace['__pyp_line']
 
         # if stdin must be passed as an iterable
         if iterable:
             # we decode all the stdin content and add it to the
             # exec context
 
-            def _():
-                for l in stdin:
-                    try:
-                        l = l.decode(in_encoding)
-                    except AttributeError:
-                        pass # note bytes
-                    yield l.rstrip(rstrip)
-
-            context['l'] = _()
+            context['l'] = read_lines()
+            if stats is not None:
+                context['l'] = stats.timed_iter('read', context['l'])
             execute_all(context)
 
         elif full:
             # we decode all the stdin content and add it to the
             # exec context
 
-            stdin = stdin.read()
-            try:
-                stdin = stdin.decode(in_encoding)
-            except AttributeError:
-                pass
-
-            context['stdin'] = stdin
+            content = stdin.read()
+            if not binary:
+                try:
+                    content = content.decode(in_encoding)
+                except AttributeError:
+                    pass
+            if stats is not None:
+                newline = "\n" if isinstance(content, text_type) else b"\n"
+                stats.lines += content.count(newline)
+                if content and not content.endswith(newline):
+                    stats.lines += 1 # the last line has no line break
+
+            context['stdin'] = content
             if split:
-                context['f'] = re.split(splitter,  context['stdin'])
+                context['f'] = make_splitter(splitter)(context['stdin'])
             execute_all(context)
 
+        # stdin is a huge json document, process the values at a path
+        # one by one
+        elif streaming:
+            values = JSONStream(stdin, json_stream, in_encoding)
+            run_records(fused or (filter_line if filter_input else
+                                  process_line),
+                        ((value, i, value)
+                         for i, value in enumerate(values, start)))
+
+        # each line of stdin is a JSON document
+        elif json_lines:
+            loads, dumps = json_codec()
+            run_records(fused or (filter_line if filter_input else
+                                  process_line),
+                        decode_json_lines(read_lines(), loads, quiet, start))
+
+        # CSV rows, with a view by column names if there is a header
+        elif csv_dialect:
+            rows = csv.reader(read_lines(""), csv_dialect)
+            indexes = None
+            if header:
+                context['header'] = next(rows, [])
+                indexes = dict((name, n) for n, name
+                               in reversed(list(enumerate(context['header']))))
+            names = referenced_names(codes + [after])
+            if 'r' not in names and names.isdisjoint(UNFUSABLE_NAMES):
+                indexes = None # no need to build the views
+
+            if fused:
+                run_records(fused, ((row, i, row,
+                                     Row(row, indexes) if indexes else None)
+                                    for i, row in enumerate(rows, start)),
+                            ('x', 'i', 'row', 'r'))
+            else:
+                process = filter_line if filter_input else process_line
+
+                def process_row(row, i):
+                    context['row'] = row
+                    context['r'] = Row(row, indexes) if indexes else None
+                    process(row, i)
+
+                run_lines(process_row, rows)
+
+        # columns of chunks of lines as NumPy arrays, for vectorized code
+        elif columns:
+            split_columns = methodcaller('split')
+            if split:
+                split_columns = make_splitter(splitter)
+            run_records(filter_chunk if filter_input else process_chunk,
+                        column_chunks(read_lines(), split_columns, schema,
+                                      quiet=quiet, start=start))
+
         # if stdin must be filtered according to an expression
         elif filter_input:
             # we decode all the stdin content, decode each line,
             # pass it as x, check if the result is True, and if yes
             # print it.
-            for i, line in enumerate(stdin, 1):
-
-                try:
-                    line = line.decode(in_encoding)
-                except AttributeError:
-                    pass # note bytes
-                line = line.rstrip(rstrip)
-
-                if split:
-                    context['f'] = re.split(splitter, line)
-
-                context['x'] = line
-                context['i'] = i
-                for expression in statements:
-                    try:
-                        try:
-                            expression = expression.decode(in_encoding)
-                        except AttributeError:
-                            pass # note a byte
-                        if not eval(expression, context):
-                            break
-                    except Exception as e:
-                        if not quiet:
-                            raise e
-                        break
-                else:
-                    print(context['x'])
+            # A simple expression is replaced by a regex search, in whole
+            # chunks if possible
+            regex, in_chunks = simple_filter()
+            if in_chunks:
+                scan_chunks(regex.search)
+            elif regex is not None:
+                run_lines(partial(match_line, regex.search))
+            else:
+                run_lines(fused or filter_line)
 
         # stdin is json, just pass it as is
         elif parse_json:
 
-            stdin = stdin.read()
-            try:
-                stdin = stdin.decode(in_encoding)
-            except AttributeError:
-                pass # not bytes
+            document = stdin.read()
+            if MappedFile is not None and isinstance(document, MappedFile):
+                document = document[:] # json only parses real bytes
+            if not binary:
+                try:
+                    document = document.decode(in_encoding)
+                except AttributeError:
+                    pass # not bytes
 
-            context['j'] = json.loads(stdin)
+            context['j'] = json.loads(document)
             execute_all(context)
 
         else:
             # if stdin must be passed line by line
             if stdin:
-
-                for i, line in enumerate(stdin, 1):
-
-                    try:
-                        line = line.decode(in_encoding)
-                    except AttributeError:
-                        pass # note bytes
-                    line = line.rstrip(rstrip)
-
-                    if split:
-                        context['f'] = re.split(splitter, line)
-
-                    context['x'] = line
-                    context['i'] = i
-                    execute_all(context)
+                run_lines(fused or process_line)
 
             # stdin is not redirected or piped : ignore it and just
             # execute the code
@@ -237,16 +2791,278 @@ def execute_statements(statements, stdin=None, additional_context=None,
                 execute_all(context)
 
     finally:
-        if after:
+        try:
+            if reduce:
+                context['r'] = reduced[0] if reduced else None
+            if after:
+                try:
+                    exec_(after, context)
+                except Exception as e:
+                    if not quiet:
+                        raise e
+        finally:
+            sys.stdout = stdout
+            if profiler is not None:
+                profiler.disable()
+            if output is not None:
+                if stats is not None:
+                    stats.timed('output', output.flush)()
+                else:
+                    output.flush()
+            if stats is not None:
+                stats.bytes = getattr(stdin, 'bytes_read', 0)
+                stats.end = stats.clock()
+
+    if reduce:
+        return context['r']
+
+def server_address():
+    """ Return the path of the unix socket the pyp server listens on.
+
+        It's in the runtime directory of the user, or in a directory of
+        the temporary directory only the user can access.
+    """
+    if os.environ.get('PYPED_SOCKET'):
+        return os.environ['PYPED_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                            'pyped-%s.sock' % os.getuid())
+    # not tempfile.gettempdir(): importing tempfile costs more than the
+    # rest of a short run
+    return os.path.join(os.environ.get('TMPDIR') or '/tmp',
+                        'pyped-%s' % os.getuid(), 'server.sock')
+
+
+def server_supported():
+    """ Tell if this Python can pass file descriptors over a unix socket,
+        and tell who is at the other end of it
+    """
+    import socket
+    return (hasattr(socket, 'AF_UNIX') and hasattr(socket, 'SCM_RIGHTS')
+            and hasattr(socket, 'SO_PEERCRED')
+            and hasattr(socket.socket, 'sendmsg'))
+
+
+def peer_uid(connection):
+    """ Return the user id of the process at the other end of a unix
+        socket
+    """
+    import socket
+    import struct
+    credentials = connection.getsockopt(socket.SOL_SOCKET,
+                                        socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid
+
+
+def owned_by_user(path, kind=stat.S_ISSOCK):
+    """ Tell if path is a socket, or a `kind` of file, owned by the user """
+    try:
+        status = os.lstat(path)
+    except EnvironmentError:
+        return False
+    return kind(status.st_mode) and status.st_uid == os.getuid()
+
+
+def private_directory(path):
+    """ Create the directory only the user can access, or check that it
+        is one
+    """
+    try:
+        os.mkdir(path, stat.S_IRWXU)
+    except EnvironmentError:
+        pass # already there, or it will fail below
+    if (not owned_by_user(path, stat.S_ISDIR)
+            or os.lstat(path).st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+        raise ValueError("%s must be a directory only you can access" % path)
+
+
+def forward_to_server(argv, address=None):
+    """ Run the command in a warm pyp server, if one is listening.
+
+        argv, the working directory and the environment are sent to the
+        server, along with our stdin, stdout and stderr file descriptors,
+        so the server reads and writes them directly.
+
+        Return the exit status of the command, or None if there is no
+        server to forward the command to.
+    """
+    address = address or server_address()
+    # we send our environment and file descriptors: make sure another
+    # user didn't put a socket here to collect them. Check the file first
+    # so that there is no socket module to import without a server.
+    if not owned_by_user(address) or not server_supported():
+        return None
+
+    import array
+    import socket
+    import struct
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(address)
+        except socket.error:
+            return None  # stale socket file: the server is not running
+        if peer_uid(client) != os.getuid():
+            return None
+
+        request = json.dumps({'argv': argv, 'cwd': os.getcwd(),
+                              'env': dict(os.environ)}).encode('utf8')
+        message = struct.pack('!I', len(request)) + request
+        fds = array.array('i', [0, 1, 2])
+        sent = client.sendmsg([message], [(socket.SOL_SOCKET,
+                                           socket.SCM_RIGHTS, fds.tobytes())])
+        client.sendall(message[sent:])
+
+        response = b''
+        while len(response) < 4:
+            chunk = client.recv(4 - len(response))
+            if not chunk:
+                sys.exit("pyp: the server closed the connection")
+            response += chunk
+        return struct.unpack('!i', response)[0]
+    finally:
+        client.close()
+
+
+def receive_request(connection):
+    """ Read a request sent by forward_to_server().
+
+        Return the request and the received file descriptors.
+    """
+    import array
+    import socket
+    import struct
+
+    fd_size = array.array('i').itemsize
+    data, ancillary, flags, address = connection.recvmsg(
+        65536, socket.CMSG_SPACE(3 * fd_size))
+
+    fds = array.array('i')
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fd_size])
+
+    while len(data) < 4 or len(data) < 4 + struct.unpack('!I', data[:4])[0]:
+        chunk = connection.recv(65536)
+        if not chunk:
+            raise ValueError('Truncated request')
+        data += chunk
+
+    size = struct.unpack('!I', data[:4])[0]
+    return json.loads(data[4:4 + size].decode('utf8')), list(fds)
+
+
+def serve_request(request, fds):
+    """ Run a forwarded command as if it was started by the client.
+
+        This is called in a forked child of the server. Return the exit
+        status of the command.
+    """
+    import signal
+    import traceback
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    try:
+        run(request['argv'])
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        sys.stderr.write("%s\n" % e.code)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return 0
+
+
+def serve(address=None):
+    """ Listen for commands forwarded by pyp clients, and run them.
+
+        The whole prelude is imported once, then each command runs in a
+        forked child, so it starts with all the modules already loaded.
+    """
+    if not server_supported():
+        sys.exit("pyp: the server needs unix sockets with SCM_RIGHTS")
+
+    import signal
+    import socket
+    import struct
+
+    address = address or server_address()
+
+    for name, spec in PRELUDE:
+        try:
+            import_prelude(name)
+        except ImportError:
+            pass
+
+    if not os.environ.get('PYPED_SOCKET'):
+        try:
+            private_directory(os.path.dirname(address))
+        except ValueError as e:
+            sys.exit("pyp: %s" % e)
+    if os.path.lexists(address):
+        os.unlink(address)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        listener.bind(address)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    # let the kernel reap the children
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    sys.stderr.write("pyp: server listening on %s\n" % address)
+
+    try:
+        while True:
+            connection, client = listener.accept()
             try:
+                # only run the commands of the user running the server
+                if peer_uid(connection) != os.getuid():
+                    raise ValueError("Request from another user")
+                request, fds = receive_request(connection)
+            except (socket.error, ValueError):
+                connection.close()
+                continue
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if not os.fork():
+                status = 1
                 try:
-                    after = after.decode(in_encoding)
-                except AttributeError:
-                    pass  # not bytes
-                exec_(after, context)
-            except Exception as e:
-                if not quiet:
-                    raise e
+                    listener.close()
+                    status = serve_request(request, fds)
+                finally:
+                    try:
+                        connection.sendall(struct.pack('!i', status))
+                    finally:
+                        os._exit(status)
+
+            for fd in fds:
+                os.close(fd)
+            connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(address)
+
 
 def main():
 
@@ -254,6 +3070,21 @@ def main():
         print('Pyped', __VERSION__)
         sys.exit(0)
 
+    if "--server" in sys.argv:
+        serve()
+        sys.exit(0)
+
+    # reuse a warm server if there is one
+    status = forward_to_server(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
+    run(sys.argv[1:])
+
+
+def run(argv):
+    """ Parse the command line arguments and execute the statements """
+
     parser = argparse.ArgumentParser(
                           description=__doc__,
                           formatter_class=argparse.RawDescriptionHelpFormatter
@@ -296,24 +3127,161 @@ def main():
     parser.add_argument("--json", action="store_true",
                         help="Parse stdin as JSON and pass the result as 'j'")
 
-    parser.add_argument("--stdin-charset", nargs='?', default="",
-                        help="Force stdin decoding with this charset")
+    parser.add_argument("--json-stream", action="store_true",
+                        help="Parse stdin as JSON incrementally, and pass each "
+                             "value at --json-path as 'j' (and 'x').")
+
+    parser.add_argument("--json-path", default="*", metavar="path",
+                        help="Where the values of --json-stream are, e.g: "
+                             "'items.*'. Default to each item of the "
+                             "top-level array.")
+
+    parser.add_argument("--jsonl", action="store_true",
+                        help="Parse each line of stdin as JSON and pass it as "
+                             "'j'. With -p, results are printed as JSON.")
+
+    parser.add_argument("--window", type=int, default=None, metavar="N",
+                        help="Pass the last N lines, up to the current one, "
+                             "as 'w'.")
+
+    parser.add_argument("--window-bytes", type=int, default=None,
+                        metavar="N",
+                        help="Pass the last lines, up to the current one and "
+                             "up to N characters (bytes with --bytes), "
+                             "as 'w'.")
 
-    parser.add_argument("--rstrip", nargs='?', default="\n",
-                        help="A character to strip from the right of the line.")
+    parser.add_argument("--csv", action="store_true",
+                        help="Parse stdin as CSV and pass each row as 'row' "
+                             "(and 'x'). Printed lists are written as CSV.")
 
-    args = parser.parse_args()
+    parser.add_argument("--tsv", action="store_true",
+                        help="Like --csv, but with tab separated values.")
 
-    # We need the imported modules to be available as a context for future
-    # exec, but they can't be included inside the function so we gather them
-    # from globals
-    context = dict(globals())
-    # Removing useless references
-    for v in ('__VERSION__', '__builtins__', '__doc__', '__file__',
-              '__name__', '__package__', 'argparse', 'division',
-              'main', 'print_function', 'stat', 'unicode_literals',
-              'absolute_import'):
-        del context[v]
+    parser.add_argument("--header", action="store_true",
+                        help="With --csv or --tsv, the first row is the "
+                             "header and 'r' gets the fields by name.")
+
+    parser.add_argument("--columns", action="store_true",
+                        help="Run the statements once per chunk of lines, "
+                             "with the fields split by -s as NumPy arrays "
+                             "in 'cols'.")
+
+    parser.add_argument("--schema", default=None, metavar="types",
+                        help="The types of the --columns, e.g: "
+                             "'str,int,price:float'. Named columns are "
+                             "available as cols['price'] too.")
+
+    parser.add_argument("--stdin-charset", nargs='?', default="",
+                        help="Force stdin decoding with this charset")
+
+    # a bare --rstrip gives None: strip all the trailing whitespace
+    parser.add_argument("--rstrip", nargs='?', default=argparse.SUPPRESS,
+                        help="A character to strip from the right of the "
+                             "line. Default to the record separator.")
+
+    parser.add_argument("--rs", default="\\n", metavar="separator",
+                        help="The record separator stdin is split on. "
+                             "Escapes are allowed, e.g: '\\0' to read "
+                             "'find -print0' output. Default to '\\n'.")
+
+    parser.add_argument("--block-size", type=int,
+                        default=RecordReader.block_size, metavar="bytes",
+                        help="Read stdin by blocks of this size.")
+
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="Print the prelude imports actually triggered "
+                             "on stderr.")
+
+    parser.add_argument("-j", type=int, default=1, metavar="N",
+                        help="Process the lines in N processes. 'before' runs "
+                             "once per process, 'after' once at the end.")
+
+    parser.add_argument("--ordered", action="store_true", default=True,
+                        help="With -j, output the lines in the input order "
+                             "(default).")
+
+    parser.add_argument("--unordered", action="store_false", dest="ordered",
+                        help="With -j, output the lines as soon as they are "
+                             "processed.")
+
+    parser.add_argument("--reduce", default=None, metavar="expression",
+                        help="Merge the results of the expression on each "
+                             "line with this expression using 'a' and 'b', "
+                             "e.g: 'a + b'. The result is passed as 'r' to "
+                             "'after', or printed.")
+
+    parser.add_argument("--bytes", action="store_true",
+                        help="Don't decode stdin: 'x', 'f', 'l' and 'stdin' "
+                             "are bytes, and printed bytes are written as is.")
+
+    parser.add_argument("--line-buffered", action="store_true",
+                        help="Write each printed line right away instead of "
+                             "buffering the output. Default if stdout is a "
+                             "terminal.")
+
+    parser.add_argument("--stats", action="store_true",
+                        help="Print on stderr how many lines were processed, "
+                             "and where the time went. --stats=json prints "
+                             "it as JSON.")
+
+    parser.add_argument("--stats-format", choices=("table", "json"),
+                        default="table", help=argparse.SUPPRESS)
+
+    parser.add_argument("--profile", action="store_true",
+                        help="Sample the statements while they run, and "
+                             "print their hottest lines on stderr. "
+                             "--profile=collapsed prints the stacks for a "
+                             "flame graph, --profile=pstats saves cProfile "
+                             "stats.")
+
+    parser.add_argument("--profile-format",
+                        choices=("table", "collapsed", "pstats"),
+                        default="table", help=argparse.SUPPRESS)
+
+    parser.add_argument("--profile-output", default=None, metavar="file",
+                        help="Write the profile in this file instead of "
+                             "stderr. Default to 'pyp.prof' with "
+                             "--profile=pstats.")
+
+    parser.add_argument("--progress", action="store_true",
+                        help="Print on stderr every second how much of stdin "
+                             "was processed, how fast, and for a file, the "
+                             "percentage done and the time left.")
+
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't use the on disk cache of compiled "
+                             "statements.")
+
+    parser.add_argument("--server", action="store_true",
+                        help="Start a server running the following pyp "
+                             "commands with a warm prelude.")
+
+    # "--stats json" would take the first statement as the format
+    argv = list(argv)
+    for n, argument in enumerate(argv):
+        option, equal, value = argument.partition('=')
+        if equal and option in ('--stats', '--profile'):
+            argv[n:n + 1] = [option, option + '-format', value]
+
+    args = parser.parse_args(argv)
+
+    separator = codecs.decode(args.rs, 'unicode_escape')
+    rstrip = getattr(args, 'rstrip', separator)
+
+    # The prelude modules are imported only if the statements use them
+    import_log = []
+    context = {}
+    stats = Stats() if args.stats else None
+    progress = None
+    profiler = None
+    if args.profile and args.profile_format == 'pstats':
+        import cProfile
+        profiler = cProfile.Profile()
+    elif args.profile:
+        profiler = SamplingProfiler()
+
+    output = Output(line_buffered=args.line_buffered or sys.stdout.isatty(),
+                    binary=args.bytes)
 
     try:
 
@@ -321,18 +3289,67 @@ def main():
         stdin = None
         mode = os.fstat(0).st_mode
         if stat.S_ISFIFO(mode) or stat.S_ISREG(mode):
-            stdin = sys.stdin
+            encoding = None
+            if not args.bytes:
+                encoding = args.stdin_charset or sys.stdin.encoding
+                if encoding in ('ascii', None, ''):
+                    encoding = 'utf8'
+            # a regular file can be mapped in memory instead of read
+            reader = RecordReader
+            if stat.S_ISREG(mode):
+                reader = MappedReader
+            stdin = reader(0, encoding, separator, args.block_size,
+                           getattr(sys.stdin, 'errors', None) or 'strict')
+            if args.progress:
+                progress = Progress(stdin, sys.stderr)
+                progress.enable()
 
         # this is where most of the work happen
-        execute_statements(args.statements, stdin=stdin,
+        result = execute_statements(args.statements, stdin=stdin,
                            additional_context=context, quiet=args.q,
                            autoprint=args.p, stdin_charset=args.stdin_charset,
                            before=args.b, after=args.a, split=args.s,
-                           iterable=args.i, rstrip=args.rstrip, full=args.full,
-                           filter_input=args.f, parse_json=args.json)
+                           iterable=args.i, rstrip=rstrip, full=args.full,
+                           filter_input=args.f, parse_json=args.json,
+                           prelude=True, import_log=import_log,
+                           cache=None if args.no_cache else CodeCache(),
+                           output=output, binary=args.bytes, jobs=args.j,
+                           ordered=args.ordered, reduce=args.reduce,
+                           json_stream=args.json_path if args.json_stream
+                                       else None,
+                           json_lines=args.jsonl, columns=args.columns,
+                           schema=args.schema,
+                           csv_dialect='excel' if args.csv else
+                                       'excel-tab' if args.tsv else None,
+                           header=args.header, window=args.window,
+                           window_bytes=args.window_bytes, stats=stats,
+                           profiler=profiler)
+
+        # without "after" to do something with the result, print it
+        if args.reduce and not args.a and result is not None:
+            output(result)
+            output.flush()
     except Exception as e:
         if not args.q:
             sys.exit("%s: %s" % (e.__class__.__name__, e))
+    finally:
+        if progress is not None:
+            progress.disable()
+        if args.startup_profile:
+            for name, module, seconds in import_log:
+                sys.stderr.write("pyp: '%s' imported from %s in %.1f ms\n"
+                                 % (name, module, seconds * 1000))
+            if not import_log:
+                sys.stderr.write("pyp: no prelude import triggered\n")
+        if stats is not None:
+            stats.report(sys.stderr, args.stats_format)
+        if profiler is not None and args.profile_format == 'pstats':
+            profiler.dump_stats(args.profile_output or 'pyp.prof')
+        elif profiler is not None and args.profile_output:
+            with open(args.profile_output, 'w') as f:
+                profiler.report(f, args.profile_format)
+        elif profiler is not None:
+            profiler.report(sys.stderr, args.profile_format)
 
 
 if __name__ == '__main__':
@@ -4,11 +4,15 @@ from __future__ import (unicode_literals, print_function)
 
 import os
 import sys
+import re
+import json
 import shlex
+import pstats
+import socket
 import tempfile
 import subprocess
 
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 
 try:
     import pytest
@@ -17,10 +21,24 @@ except ImportError:
 
 import six
 
-from pyped import execute_statements, __VERSION__
+from pyped import (execute_statements, fuse_statements, prelude_context,
+                   LazyImport, referenced_names, CodeCache, Output,
+                   RecordReader, JSONStream, decode_json_lines, filter_regex,
+                   make_splitter, fields_usage, fields_lazy_enough, Fields,
+                   AwkFields,
+                   parse_schema, MappedReader, mapped_file_type,
+                   ByteWindow,
+                   Stats, SamplingProfiler, Progress, server_supported,
+                   owned_by_user, peer_uid, private_directory,
+                   forward_to_server, __VERSION__)
 
 
 
+@pytest.fixture(autouse=True)
+def cache_home(tmpdir, monkeypatch):
+    """ Keep the code cache of the commands out of the user's cache """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+
 @pytest.fixture
 def assert_print(capfd):
     """ Return a function that check expected strings have been printed """
@@ -301,6 +319,584 @@ def test_option_filter(assert_print):
     assert_print("1", "2", "3")
 
 
+def test_statements_are_compiled_once():
+    import traceback
+    with pytest.raises(ZeroDivisionError) as excinfo:
+        wrapper([b"y = 1", b"y / 0"], [b"a"])
+    frame = traceback.extract_tb(excinfo.tb)[-1]
+    assert frame[0] == "<pyp:stmt 2>"
+    assert frame[3] == "y / 0"
+
+    # syntax errors are raised before reading stdin, unless quiet
+    with pytest.raises(SyntaxError):
+        wrapper(b"1 +", [b"a"])
+    wrapper([b"1 +", b"print(x)"], [b"a"], quiet=True)
+
+
+def test_fused_statements(assert_print):
+    assert fuse_statements(["x.upper()"], autoprint=True)
+    assert fuse_statements(["print(f[0])"], split=True)
+    assert fuse_statements(["[y for y in x]"], autoprint=True)
+    # binding names must go through the context
+    assert fuse_statements(["y = x"]) is None
+    assert fuse_statements(["import os"]) is None
+    assert fuse_statements(["locals()"]) is None
+
+    wrapper(b"x.upper()", [b"a", b"b"], autoprint=True, after=b"print(i, x)")
+    assert_print("A", "B", "2 b")
+
+    wrapper(b"1 / int(x)", [b"0", b"2"], autoprint=True, quiet=True)
+    assert_print("0.5")
+
+    wrapper(b"c += int(x)", [b"1", b"2"], before=b"c = 0", after=b"print(c)")
+    assert_print("3")
+
+    # code defined outside of the statements reads the line from the context
+    wrapper(b"g()", [b"a", b"b"], autoprint=True,
+            before=b"def g(): return x.upper() + str(i)")
+    assert_print("A1", "B2")
+    wrapper(b"long()", [b"a", b"bb"], filter_input=True,
+            before=b"def long(): return len(x) > 1")
+    assert_print("bb")
+    wrapper(b"lst.append(lambda: x)", [b"a", b"b"], before=b"lst = []",
+            after=b"print([g() for g in lst])")
+    assert_print("['b', 'b']")
+
+
+def test_lazy_prelude(assert_print):
+    log = []
+    context = prelude_context(log)
+    assert isinstance(context['Counter'], LazyImport)
+    wrapper(b"print(Counter(x)['a'])", [b"aa"], additional_context=context)
+    assert_print("2")
+    assert [name for name, module, seconds in log] == ['Counter']
+    # the proxy is replaced by the real object once imported
+    from collections import Counter
+    assert context['Counter'] is Counter
+    assert isinstance(context['json'], LazyImport)
+
+
+def test_option_prelude(assert_print):
+    assert referenced_names([compile("[json.dumps(y) for y in x]", "", "eval")]
+                            ) >= {'json', 'dumps', 'x'}
+
+    log = []
+    context = {}
+    wrapper(b"print(Counter(x)['a'])", [b"aa"], additional_context=context,
+            prelude=True, import_log=log)
+    assert_print("2")
+    assert [name for name, module, seconds in log] == ['Counter']
+    assert 'json' not in context
+
+    # we can't know what eval() will use
+    context = {}
+    wrapper(b"print(eval('math.floor(1.5)'))", additional_context=context,
+            prelude=True)
+    assert_print("1")
+    assert isinstance(context['json'], LazyImport)
+
+
+def test_option_cache(tmpdir, assert_print, capfd):
+    cache = CodeCache(str(tmpdir))
+    wrapper(b"x.upper()", [b"a"], autoprint=True, cache=cache)
+    assert_print("A")
+    # one entry for the statement, one for the fused function
+    assert len(tmpdir.listdir()) == 2
+
+    key = cache.key("x.upper()", "<pyp:stmt 1>", "eval")
+    assert cache.get(key).co_filename == "<pyp:stmt 1>"
+    wrapper(b"x.upper()", [b"b"], autoprint=True, cache=cache)
+    assert_print("B")
+    assert len(tmpdir.listdir()) == 2
+
+    # statements that can't be fused are cached too
+    wrapper(b"y = x", [b"a"], after=b"print(y)", cache=cache)
+    assert_print("a")
+    assert len(tmpdir.listdir()) == 5
+
+    # one statement per line is not the same as one statement per argument
+    wrapper([b"print(1/0)", b"print(x)"], [b"a"], quiet=True, cache=cache)
+    assert_print("a")
+    wrapper([b"print(1/0)\nprint(x)"], [b"a"], quiet=True, cache=cache)
+    assert capfd.readouterr()[0] == ""
+
+    # the least recently used entries are evicted
+    os.utime(tmpdir.join(key).strpath, (0, 0))
+    cache.max_size = 10
+    cache.set(cache.key("new"), 1)
+    assert not tmpdir.join(key).exists()
+    assert len(tmpdir.listdir()) < 5
+    assert cache.get(cache.key("new")) == 1
+
+
+def test_option_output():
+    raw = BytesIO()
+    stream = TextIOWrapper(raw, encoding='utf8')
+    output = Output(stream)
+    wrapper(b"x.upper()", [b"\xc3\xa9", b"b"], autoprint=True, output=output,
+            after=b"print(i, x, sep='-', end='.')")
+    assert raw.getvalue() == "\xc9\nB\n2-b.".encode('utf8')
+
+    # nothing is written until the buffer is full or flushed
+    raw = BytesIO()
+    output = Output(TextIOWrapper(raw, encoding='utf8'), buffer_size=4)
+    output("ab")
+    assert raw.getvalue() == b""
+    output("cd")
+    assert raw.getvalue() == b"ab\ncd\n"
+
+    # unless it's line buffered
+    raw = BytesIO()
+    output = Output(TextIOWrapper(raw, encoding='utf8'), line_buffered=True)
+    output("ab")
+    assert raw.getvalue() == b"ab\n"
+
+    # what is written to sys.stdout is in order with what is printed
+    raw = BytesIO()
+    output = Output(TextIOWrapper(raw, encoding='utf8'))
+    stdout = sys.stdout
+    wrapper(b"print('head', x); sys.stdout.write(x + '!\\n')", [b"a", b"b"],
+            output=output, additional_context={'sys': sys})
+    assert raw.getvalue() == b"head a\na!\nhead b\nb!\n"
+    assert sys.stdout is stdout
+
+
+def test_option_binary(capfd):
+    raw = BytesIO()
+    output = Output(TextIOWrapper(raw), binary=True)
+    wrapper(b"print(x, f[1])", [b"a-\xff", b"b-c"], split="-", binary=True,
+            output=output)
+    assert raw.getvalue() == b"a-\xff \xff\nb-c c\n"
+
+    wrapper(b"type(x).__name__", [b"a"], autoprint=True, binary=True)
+    wrapper(b"type(stdin).__name__", [b"a"], autoprint=True, binary=True,
+            full=True)
+    assert capfd.readouterr()[0] == "bytes\nbytes\n"
+
+
+def reader(data, *args, **kwargs):
+    """ Return a RecordReader, or a 'cls' reader, on a file containing data """
+    cls = kwargs.pop('cls', RecordReader)
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    f.seek(kwargs.pop('offset', 0))
+    return cls(os.dup(f.fileno()), *args, **kwargs)
+
+def test_record_reader():
+    data = "é\nbb\r\n\nccc".encode('utf8')
+    # blocks smaller than the lines
+    assert list(reader(data, 'utf8', block_size=2)) == ["é\n", "bb\r\n",
+                                                         "\n", "ccc"]
+    assert list(reader(data, 'utf8').lines("\n")) == ["é", "bb\r", "", "ccc"]
+    assert list(reader(data, 'utf8').lines("c")) == ["é\n", "bb\r\n", "\n",
+                                                     ""]
+    assert list(reader(data).lines(b"\n")) == ["é".encode('utf8'), b"bb\r",
+                                                b"", b"ccc"]
+    assert list(reader(b"a\0b\0", separator="\0").lines(b"\0")) == [b"a",
+                                                                    b"b"]
+    assert reader(data, 'utf8', block_size=3).read() == "é\nbb\r\n\nccc"
+    # Windows line breaks are translated like the text stdin did there
+    translating = reader(data, 'utf8')
+    translating.universal_newlines = True
+    assert list(translating) == ["é\n", "bb\n", "\n", "ccc"]
+
+
+def test_mapped_reader():
+    data = "é\nbb\r\n\nccc".encode('utf8')
+    for block_size in (2, 3, None):
+        assert list(reader(data, 'utf8', block_size=block_size,
+                           cls=MappedReader)) == ["é\n", "bb\r\n", "\n",
+                                                  "ccc"]
+    assert list(reader(data, cls=MappedReader).lines(b"\n")) == [
+        "é".encode('utf8'), b"bb\r", b"", b"ccc"]
+    assert reader(data, 'utf8', cls=MappedReader).read() == "é\nbb\r\n\nccc"
+    # starts where the file offset is
+    assert list(reader(data, 'utf8', cls=MappedReader, offset=3)) == [
+        "bb\r\n", "\n", "ccc"]
+
+    mapped = reader(data, cls=MappedReader)
+    stdin = mapped.read()
+    assert isinstance(stdin, mapped_file_type()) and mapped.bytes_read == len(data)
+    assert len(stdin) == len(data) and stdin.find(b"ccc") == 8
+    assert b"bb" in stdin and stdin == data
+    assert stdin.split(b"\n")[-1] == b"ccc"
+    assert os.lseek(mapped.fd, 0, os.SEEK_CUR) == len(data)
+
+    # empty files can't be mapped
+    assert reader(b"", 'utf8', cls=MappedReader).read() == ""
+    assert list(reader(b"", cls=MappedReader)) == []
+
+
+def test_option_jobs(assert_print, capfd):
+    lines = [str(n).encode('ascii') for n in range(1, 30001)]
+    wrapper(b"int(x) * 2", lines, autoprint=True, jobs=3,
+            after=b"print(i, x)")
+    assert_print(*[str(n * 2) for n in range(1, 30001)] + ["30000 30000"])
+
+    # before runs in each worker, i is the line number in the whole input
+    wrapper(b"n % 2 == 0 and int(x) == i", [b"1", b"2", b"3", b"4"],
+            filter_input=True, jobs=2, before=b"n = 0", split=b",")
+    assert_print("1", "2", "3", "4")
+
+    with pytest.raises(ZeroDivisionError):
+        wrapper(b"1 / int(x)", [b"1", b"0"], jobs=2)
+
+    # "after" gets the fields of the last line too
+    wrapper(b"pass", [b"a,b", b"c,d"], jobs=2, split=b",",
+            after=b"print('-'.join(f), F[1], F.nf)")
+    assert_print("c-d c 2")
+
+    execute_statements([b"print(x)"],
+                       reader(b"a\nb\nc\n", 'utf8', block_size=2),
+                       jobs=2, ordered=False)
+    assert sorted(capfd.readouterr()[0].split()) == ["a", "b", "c"]
+
+    # workers read their own ranges of a mapped file
+    data = "".join("%s é\n" % n for n in range(1, 5001)).encode('utf8')
+    stdin = reader(data, 'utf8', block_size=1000, cls=MappedReader)
+    execute_statements([b"x.upper()"], stdin, jobs=3, autoprint=True,
+                       after=b"print(i, x)")
+    assert_print(*["%s É" % n for n in range(1, 5001)] + ["5000 5000 é"])
+    assert stdin.bytes_read == len(data)
+    execute_statements([b"len(x)"], reader(data, 'utf8', cls=MappedReader),
+                       jobs=2, autoprint=True, reduce=b"a + b",
+                       after=b"print(r, x)")
+    assert_print("%s 5000 é" % sum(len("%s é" % n) for n in range(1, 5001)))
+    # lines are counted for the functions of "before" too
+    stdin = reader(data, 'utf8', block_size=1000, cls=MappedReader)
+    execute_statements([b"g()"], stdin, jobs=2, autoprint=True,
+                       before=b"def g(): return i")
+    assert_print(*[str(n) for n in range(1, 5001)])
+    # the last line is whole, even if it's longer than a block
+    stdin = reader(b"a\n" + "é".encode('utf8') * 40, 'utf8', block_size=16,
+                   cls=MappedReader)
+    execute_statements([b"pass"], stdin, jobs=2, after=b"print(i, x)")
+    assert_print("2 " + "é" * 40)
+
+
+def test_option_reduce(assert_print):
+    lines = [str(n % 3).encode('ascii') for n in range(30000)]
+    assert wrapper(b"int(x)", lines, reduce=b"a + b") == 30000
+
+    # None results are skipped, and "after" gets the result as 'r'
+    wrapper(b"Counter([x]) if x != '0' else None", lines, reduce="a + b",
+            prelude=True, after=b"print(sorted(r.items()))")
+    assert_print("[('1', 10000), ('2', 10000)]")
+
+    # the merge function can come from "before", and works with jobs
+    assert wrapper(b"int(x)", lines, reduce="m(a, b)", jobs=3,
+                   before=b"m = lambda a, b: max(a, b)") == 2
+    assert wrapper(b"Counter([x])", lines, reduce="a + b", jobs=3,
+                   prelude=True)['0'] == 10000
+
+    with pytest.raises(ValueError):
+        wrapper(b"int(x)", lines, reduce="a + b", filter_input=True)
+
+
+def test_json_stream():
+    data = b'{"a": 1, "items": [{"n": 1}, {"n": 12345.5}, [3, "x"]], "z": [7]}'
+    for size in (1, 3, 1000):
+        stream = JSONStream(BytesIO(data), "items.*")
+        stream.block_size = size
+        assert list(stream) == [{"n": 1}, {"n": 12345.5}, [3, "x"]]
+
+    assert list(JSONStream(BytesIO(data), "items.1.n")) == [12345.5]
+    assert list(JSONStream(BytesIO(data), "*")) == [1, [{"n": 1}, {"n": 12345.5},
+                                                       [3, "x"]], [7]]
+    assert list(JSONStream(BytesIO(data), "")) == [json.loads(data.decode())]
+    assert list(JSONStream(BytesIO(b" [ ] "))) == []
+    assert list(JSONStream(BytesIO("[\"é\"]".encode('cp1252')), "*",
+                           "cp1252")) == ["é"]
+
+    with pytest.raises(ValueError):
+        list(JSONStream(BytesIO(b"[1, 2")))
+
+def test_option_json_stream(assert_print):
+    wrapper(b"j['a']", b'[{"a": 1}, {"a": 2}]', autoprint=True,
+            json_stream="*", after=b"print(i, x)")
+    assert_print("1", "2", "2 {'a': 2}")
+
+    wrapper(b"j['a'] > 1", b'{"k": [{"a": 1}, {"a": 2}]}', filter_input=True,
+            json_stream="k.*")
+    assert_print('{"a":2}')
+
+    with pytest.raises(ValueError):
+        wrapper(b"j", b'[1]', json_stream="*", parse_json=True)
+
+    # a value much bigger than a block is not parsed again for each block
+    read, write = os.pipe()
+    os.write(write, b'[' + json.dumps(list(range(5000))).encode() + b', 1]')
+    os.close(write)
+    stream = JSONStream(RecordReader(read, block_size=64))
+    stream.block_size = 64
+    calls = []
+    raw_decode = stream.json_decoder.raw_decode
+    stream.json_decoder.raw_decode = lambda *args: (calls.append(args[1])
+                                                    or raw_decode(*args))
+    values = list(stream)
+    assert len(values[0]) == 5000 and values[1] == 1
+    assert len(calls) < 20
+    os.close(read)
+
+
+def test_option_json_lines(assert_print):
+    lines = ['{"a": %s}' % n for n in range(2500)]
+    lines[1500] = "bad"
+    decoded = list(decode_json_lines(lines + ["", " "], quiet=True))
+    assert len(decoded) == 2499
+    assert decoded[1500] == ('{"a": 1501}', 1502, {"a": 1501})
+    with pytest.raises(ValueError):
+        list(decode_json_lines(lines))
+    # lines with several values are malformed too
+    with pytest.raises(ValueError):
+        list(decode_json_lines(["1, 2", "[3", "4]"]))
+
+    wrapper(b"j['a'] > 1", [b'{"a": 1}', b'{"a": 2}'], filter_input=True,
+            json_lines=True, after=b"print(i, j)")
+    assert_print('{"a": 2}', "2 {'a': 2}")
+
+    wrapper(b"[j['a'], x]", [b'{"a": 1}', b'bad', b'{"a": "\xc3\xa9"}'],
+            autoprint=True, json_lines=True, quiet=True)
+    assert_print('[1,"{\\"a\\": 1}"]', '["é","{\\"a\\": \\"é\\"}"]')
+
+
+def test_fields_splitting(assert_print):
+    lines = ["a b  c", " a b", "a b ", "", "a\tb", "a--b-c"]
+    for pattern in [r"\s+", " ", "-", "--", r"-+", "b"]:
+        for maxsplit in (0, 1, 2):
+            split = make_splitter(pattern, maxsplit)
+            for line in lines:
+                assert split(line) == re.split(pattern, line, maxsplit)
+    assert make_splitter(br"\s+")(b" a b") == [b"", b"a", b"b"]
+
+    assert fields_usage(["x.upper()"]) is None
+    assert fields_usage(["f[0] + f[2]", "print(f[1])"]) == 2
+    assert fields_usage(["f[-1]"]) == -1
+    assert fields_usage(["f[i]"]) == -1
+    assert fields_usage(["f[0]", "len(f)"]) == -1
+    assert fields_usage(["eval('f')"]) == -1
+
+    calls = []
+    fields = Fields("a b", lambda line: calls.append(line) or line.split())
+    assert not calls
+    assert fields[-1] == "b" and list(fields) == ["a", "b"]
+    assert fields == ["a", "b"] and calls == ["a b"]
+
+    # anything else than subscripts, len() or iterations needs a list
+    assert fields_lazy_enough(["if x: print(f[0], len(f), [y for y in f])"])
+    assert not fields_lazy_enough(["if x: f.sort()"])
+    assert not fields_lazy_enough(["if x: print([1] + f)"])
+    wrapper(b"if x: f.sort(); print(json.dumps(f))", [b"b,a", b""],
+            split=",", additional_context={'json': json})
+    assert_print('["a", "b"]')
+    wrapper(b"if x: print(g())", [b"b,a"], split=",",
+            before=b"def g(): return ['c'] + f")
+    assert_print("['c', 'b', 'a']")
+
+    wrapper(b"f[1]", [b" a b", b"c d e"], split=r"\s+", autoprint=True,
+            after=b"print(f)")
+    assert_print("a", "d", "['c', 'd', 'e']")
+    wrapper(b"x.startswith('c') or f[-1] == 'b'", [b" a b", b"c d e", b"f g"],
+            split=r"\s+", filter_input=True)
+    assert_print(" a b", "c d e")
+
+
+def test_awk_fields(assert_print):
+    F = AwkFields(" a 1  2.5 ")
+    assert (F[0], F[1], F[-1], F.nf, list(F)) == (
+        " a 1  2.5 ", "a", "2.5", 3, ["a", "1", "2.5"])
+    assert F.int(2) == 1 and F.float(3) == 2.5 and F.float(-1) == 2.5
+    F._fields[1] = "2"
+    assert F.int(2) == 1 # converted once
+    with pytest.raises(IndexError):
+        F[4]
+    assert (F[1:3], F[2:], F[:-1], F[::2]) == (
+        ["a", "2"], ["2", "2.5"], ["a", "2"], ["a", "2.5"])
+
+    wrapper(b"F.int(2) + F.float(-1)", [b"a 1 2", b"b 3 4.5"],
+            autoprint=True, after=b"print(F[1], F.nf)")
+    assert_print("3.0", "7.5", "b 3")
+    wrapper(b"F.int(2) > 1", [b"a,1", b"b,3"], split=",", filter_input=True)
+    assert_print("b,3")
+
+    # F defined by "before" is left alone
+    wrapper(b"F.append(x)", [b"a 1", b"b 2"], before=b"F = []",
+            after=b"print(F)")
+    assert_print("['a 1', 'b 2']")
+
+
+def test_option_columns(assert_print):
+    assert parse_schema("str, int,price:float,f4") == [
+        (None, "U"), (None, "int64"), ("price", "float64"), (None, "f4")]
+
+    pytest.importorskip("numpy")
+    lines = [b"a 1 0.5", b"b 2 1.5", b"a 3 2"]
+    wrapper(b"cols[1].sum() + cols['price'].sum()", lines, columns=True,
+            schema="name:str,int,price:float", autoprint=True)
+    assert_print("10.0")
+    wrapper(b"(cols[0] == 'a')", lines, columns=True, schema="str,int",
+            filter_input=True, after=b"print(i, len(x))")
+    assert_print("a 1 0.5", "a 3 2", "1 3")
+    with pytest.raises(ValueError):
+        wrapper(b"cols", lines + [b"c"], columns=True)
+    wrapper(b"cols[1]", lines + [b"c"], columns=True, split=" ",
+            autoprint=True, quiet=True)
+    assert_print("['1' '2' '3']")
+
+
+def test_option_csv(assert_print):
+    lines = [b"name,age", b"bob,3", b'"a, b",40', b'"multi', b'line",5']
+    wrapper(b"int(r['age']) > 3", lines, csv_dialect="excel", header=True,
+            filter_input=True, after=b"print(i, header, dict(r))")
+    assert_print('"a, b",40', '"multi', 'line",5',
+                 "3 ['name', 'age'] {'name': 'multi\\nline', 'age': '5'}")
+    wrapper(b"row[0]", lines[:3], csv_dialect="excel", autoprint=True)
+    assert_print("name", "bob", "a, b")
+    wrapper(b"print(r)", lines[:2], csv_dialect="excel", header=True)
+    assert_print("{'name': 'bob', 'age': '3'}")
+    wrapper(b"[row[1], row[0]]", [b"a\tb c"], csv_dialect="excel-tab",
+            autoprint=True)
+    assert_print("b c\ta")
+    with pytest.raises(ValueError):
+        wrapper(b"row", lines, csv_dialect="excel", split=",")
+
+
+def test_option_window(assert_print):
+    lines = [str(n).encode('ascii') for n in range(1, 12)]
+    wrapper(b"if x.endswith('5'): print(list(w))", lines, window=3)
+    assert_print("['3', '4', '5']")
+    wrapper(b"'|'.join(w)", lines, window_bytes=4, autoprint=True,
+            after=b"print(len(w))")
+    assert_print("1", "1|2", "1|2|3", "1|2|3|4", "2|3|4|5", "3|4|5|6",
+                 "4|5|6|7", "5|6|7|8", "6|7|8|9", "8|9|10", "10|11", "2")
+    wrapper(b"len(w) == 2", lines[:3], window=2, filter_input=True)
+    assert_print("2", "3")
+
+    window = ByteWindow(3)
+    window.append("abcd")
+    assert list(window) == ["abcd"]
+    window.append("e")
+    assert list(window) == ["e"] and window.length == 1
+
+    with pytest.raises(ValueError):
+        wrapper(b"w", lines, window=2, full=True)
+
+
+def test_option_stats(assert_print):
+    stats = Stats()
+    wrapper([b"f[1]", b"1 / int(f[0])"], [b"1 a", b"0 b", b"x c"],
+            split=" ", autoprint=True, quiet=True, stats=stats)
+    assert_print("a", "1.0", "b", "c")
+    summary = stats.summary()
+    assert summary['lines'] == 3 and summary['exceptions'] == 2
+    phases = dict((phase['name'], phase['calls'])
+                  for phase in summary['phases'])
+    assert phases == {'read': 3, 'split': 3, 'stmt 1: f[1]': 3,
+                      'stmt 2: 1 / int(f[0])': 3, 'output': 4}
+
+    output = six.StringIO()
+    stats.report(output)
+    assert "3 lines" in output.getvalue()
+    assert "stmt 2: 1 / int(f[0])" in output.getvalue()
+
+    # the whole stdin is counted too
+    stats = Stats()
+    execute_statements([b"pass"], reader(b"a\nb\nc", 'utf8'), full=True,
+                       stats=stats)
+    assert stats.lines == 3 and stats.bytes == 5
+
+
+def test_option_profile(assert_print):
+    profiler = SamplingProfiler(interval=0.0005)
+    wrapper(b"y = x.upper()\nz = sum(range(3000000))\nprint(y)",
+            [b"a", b"b", b"c"], profiler=profiler)
+    assert_print("A", "B", "C")
+    assert profiler.thread is None
+    count, filename, lineno = profiler.lines()[0]
+    assert (filename, lineno) == ('<pyp:stmt 1>', 2)
+    assert any(";<pyp:stmt 1>:2 " in line for line in profiler.collapsed())
+
+    output = six.StringIO()
+    profiler.report(output)
+    assert "<pyp:stmt 1>:2  z = sum(range(3000000))" in output.getvalue()
+
+
+def test_option_progress():
+    stream = six.StringIO()
+    stdin = reader(b"skipped\na\nbb\nccc\n", 'utf8', offset=8)
+    progress = Progress(stdin, stream, interval=60)
+    assert progress.total == 9 # from the offset to the end
+    progress.enable()
+    assert list(stdin.lines("\n")) == ["a", "bb", "ccc"]
+    progress.disable()
+    assert stream.getvalue().startswith("pyp: 3 lines, 0.0 MB in 0:00:00 (")
+    assert stream.getvalue().endswith("MB/s), 100.0%\n")
+
+    # no size to compare to for a pipe, or lines for a full read
+    stream = six.StringIO()
+    read, write = os.pipe()
+    os.write(write, b"a\nb\n")
+    os.close(write)
+    stdin = RecordReader(read)
+    progress = Progress(stdin, stream)
+    assert progress.total is None
+    progress.enable()
+    assert stdin.read() == b"a\nb\n"
+    progress.disable()
+    os.close(read)
+    assert re.match(r"pyp: 0.0 MB in 0:00:00 \([\d.]+ MB/s\)\n$",
+                    stream.getvalue())
+
+
+def test_filter_regex(assert_print, tmpdir):
+    regex = filter_regex("'a.' in x or x.startswith(('b', 'c')) "
+                         "or x.endswith('d')")
+    assert regex.pattern == r"a\.|\A(?:b|c)|(?:d)\Z"
+    regex = filter_regex("x.startswith('b') or re.match(r'(a)\\1', x)")
+    assert [line for line in ("aa", "ab", "bc", "cb") if regex.search(line)] \
+        == ["aa", "bc"]
+    assert filter_regex("x.endswith('d')", multiline=True).pattern == "(?:d)$"
+
+    # anything else is evaluated as usual
+    for expression in ("'a' not in x", "x.startswith(y)", "'a' in x and x",
+                       "x.startswith('a', 1)", "re.search('(a)', x) or "
+                       "re.search('(b)', x)", "re.search('a', x, re.I)",
+                       "re.search('(', x)", "b'a' in x",
+                       "x.startswith('b') or re.search('(?i)a', x)"):
+        assert filter_regex(expression) is None
+    assert filter_regex("re.search('a', x)", multiline=True) is None
+    assert filter_regex("'\\n' in x", multiline=True) is None
+
+    # the pattern, or the lack of one, comes from the cache when it can
+    cache = CodeCache(str(tmpdir))
+    assert filter_regex("'a' in x", cache=cache).pattern == "a"
+    assert filter_regex("'a' not in x", cache=cache) is None
+    assert len(tmpdir.listdir()) == 2
+    cache.set(cache.key("'a' in x", '<pyp:filter>', False), "b")
+    assert filter_regex("'a' in x", cache=cache).pattern == "b"
+    assert filter_regex("'a' not in x", cache=cache) is None
+
+    # in whole chunks, with blocks smaller than the lines
+    data = b"ab\nb\n\nba\nab"
+    for block_size in (None, 3):
+        stdin = reader(data, 'utf8', block_size=block_size)
+        execute_statements(["x.startswith('a') or x.endswith('')"], stdin,
+                           filter_input=True)
+        assert_print("ab", "b", "", "ba", "ab")
+        stdin = reader(data, 'utf8', block_size=block_size)
+        execute_statements(["'b' in x"], stdin, filter_input=True)
+        assert_print("ab", "b", "ba", "ab")
+        assert stdin.records_read == 5 # for --progress
+
+    # line by line, where 're' must be the module
+    wrapper([b"re.search(r'^b|a$', x)"], [b"ab", b"b", b"ba"],
+            filter_input=True, additional_context={'re': re})
+    assert_print("b", "ba")
+    with pytest.raises(AttributeError):
+        wrapper([b"re.search(r'^b|a$', x)"], [b"ab", b"b", b"ba"],
+                filter_input=True, additional_context={'re': None})
+
+
 def test_command_version(assert_cmd_print):
     assert_cmd_print(b"--version", b"Pyped " + __VERSION__.encode('ascii'))
 
@@ -335,6 +931,9 @@ def test_command_iterable(assert_cmd_print):
 def test_command_rstrip(assert_cmd_print):
     assert_cmd_print([b"print(x)", b"--rstrip=''"],
                      [b"1", b"",  b"2", b"\n"], [b"1", b"2"])
+    # without a value, all the trailing whitespace is stripped
+    assert_cmd_print([b"print(x + '|')", b"--rstrip"],
+                     [b"1|", b"2|"], [b"1  ", b"2\t"])
 
 def test_command_full(assert_cmd_print):
     assert_cmd_print([b"print(stdin)", b"--full"],
@@ -351,6 +950,129 @@ def test_command_filter(assert_cmd_print):
     assert_cmd_print([b"not int(x) % 2", b'-f'],
                      [b"2", b"4"], [b"1", b"2", b"3", b"4"])
 
+def test_command_startup_profile():
+    res = subprocess.check_output([sys.executable, "pyped.py",
+                                   "print(math.pi > 3)", "--startup-profile"],
+                                  stderr=subprocess.STDOUT)
+    assert b"True" in res
+    assert b"'math' imported from math" in res
+    assert b"json" not in res
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason="needs unix sockets")
+def test_command_server(tmpdir):
+    env = dict(os.environ, PYPED_SOCKET=str(tmpdir.join('pyp.sock')))
+    server = subprocess.Popen([sys.executable, "pyped.py", "--server"],
+                              env=env, stderr=subprocess.PIPE)
+    try:
+        assert b"listening" in server.stderr.readline()
+
+        fake_pipe = tempfile.TemporaryFile()
+        fake_pipe.write(b"a\nb\n")
+        fake_pipe.seek(0)
+        res = subprocess.check_output([sys.executable, "pyped.py", "-p",
+                                       "'%s %s' % (x, os.getppid())"],
+                                      stdin=fake_pipe, env=env)
+        assert res == ("a %s\nb %s\n" % (server.pid, server.pid)).encode()
+
+        client = subprocess.Popen([sys.executable, "pyped.py", "1/0"],
+                                  stderr=subprocess.PIPE, env=env)
+        assert b"ZeroDivisionError" in client.stderr.read()
+        assert client.wait() == 1
+    finally:
+        server.terminate()
+        server.wait()
+
+@pytest.mark.skipif(not server_supported(), reason="needs SO_PEERCRED")
+def test_server_checks(tmpdir):
+    # never send anything to a path that is not our socket
+    path = str(tmpdir.join('pyp.sock'))
+    open(path, 'w').close()
+    assert not owned_by_user(path)
+    assert forward_to_server(["pass"], path) is None
+
+    left, right = socket.socketpair(socket.AF_UNIX)
+    assert peer_uid(left) == os.getuid()
+    left.close()
+    right.close()
+
+    directory = str(tmpdir.join('private'))
+    private_directory(directory)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    os.chmod(directory, 0o755)
+    with pytest.raises(ValueError):
+        private_directory(directory)
+
+def test_command_bytes():
+    fake_pipe = tempfile.TemporaryFile()
+    fake_pipe.write(b"a\xffb\nc\n")
+    fake_pipe.seek(0)
+    res = subprocess.check_output([sys.executable, "pyped.py", "--bytes",
+                                   "-p", "x.upper() + b'!'"], stdin=fake_pipe)
+    assert res == b"A\xffB!\nC!\n"
+
+def test_command_record_separator():
+    fake_pipe = tempfile.TemporaryFile()
+    fake_pipe.write(b"a\0b c\0")
+    fake_pipe.seek(0)
+    res = subprocess.check_output([sys.executable, "pyped.py", "--rs", "\\0",
+                                   "-p", "x.upper()"], stdin=fake_pipe)
+    assert res == b"A\nB C\n"
+
+@pytest.mark.skipif(os.name == 'nt', reason="stdin translates line breaks")
+def test_command_crlf():
+    # like the text stdin, the line breaks of the input are kept as is
+    for args in (["-p", "repr(x)"], ["print(x)"], ["print(stdin)", "--full"]):
+        fake_pipe = tempfile.TemporaryFile()
+        fake_pipe.write(b"a\r\nb\r\n")
+        fake_pipe.seek(0)
+        res = subprocess.check_output([sys.executable, "pyped.py"] + args,
+                                      stdin=fake_pipe)
+        expected = {"-p": b"'a\\r'\n'b\\r'\n", "print(x)": b"a\r\nb\r\n",
+                    "print(stdin)": b"a\r\nb\r\n\n"}[args[0]]
+        assert res.replace(b"u'", b"'") == expected
+
+def test_command_stats():
+    fake_pipe = tempfile.TemporaryFile()
+    fake_pipe.write(b"a\nb\n")
+    fake_pipe.seek(0)
+    process = subprocess.Popen([sys.executable, "pyped.py", "--stats=json",
+                                "-p", "x.upper()"], stdin=fake_pipe,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    assert out == b"A\nB\n"
+    stats = json.loads(err.decode('utf8'))
+    assert stats['lines'] == 2 and stats['bytes'] == 4
+
+def test_command_profile():
+    fake_pipe = tempfile.TemporaryFile()
+    fake_pipe.write(b"a\nb\n")
+    fake_pipe.seek(0)
+    profile = tempfile.NamedTemporaryFile(suffix='.prof', delete=False)
+    profile.close()
+    try:
+        res = subprocess.check_output([sys.executable, "pyped.py",
+                                       "--profile=pstats", "--profile-output",
+                                       profile.name, "-p", "x.upper()"],
+                                      stdin=fake_pipe)
+        assert res == b"A\nB\n"
+        stats = pstats.Stats(profile.name)
+        assert any(filename == '<pyp:stmt 1>'
+                   for filename, lineno, name in stats.stats)
+    finally:
+        os.remove(profile.name)
+
+def test_command_jobs(assert_cmd_print):
+    assert_cmd_print([b"x.upper()", b"-p", b"-j", b"2", b"-a", b"print(i)"],
+                     [b"A", b"B", b"2"], [b"a", b"b"])
+
+def test_command_reduce(assert_cmd_print):
+    assert_cmd_print([b"int(x)", b"--reduce", b"a + b"], [b"6"],
+                     [b"1", b"2", b"3"])
+
+def test_command_json_stream(assert_cmd_print):
+    assert_cmd_print([b"j['a']", b"-p", b"--json-stream"], [b"1", b"2"],
+                     b'[{"a": 1}, {"a": 2}]')
+
 def test_command_error(capfd):
     res = subprocess.Popen([sys.executable, "pyped.py", "1/0"],
                            stderr=subprocess.PIPE)